@@ -2,7 +2,6 @@ import ctypes as c
 import ctypes.util
 import cairo
 import itertools
-import operator
 
 FT = c.cdll.LoadLibrary(ctypes.util.find_library('freetype'))
 
@@ -69,14 +68,14 @@ for f, argtypes, restype in CAIRO_FUNCS:
 
 
 class Face(object):
-    # This is the hashing scheme
-    _context = None, None
-
     def __init__(self, name, index=0):
         self.face = FT_Face()
         self._as_parameter_ = self.face
         FT.FT_New_Face(LIB, name, 0, ptr(self.face))
         self._cairoface = CAIRO.cairo_ft_font_face_create_for_ft_face(self.face, 0)
+        # Glyph name or char code -> glyph index
+        self._indices = {}
+        self._font_face = None
 
     def select_charmap(self, encoding):
         return FT.FT_Select_Charmap(self, encoding)
@@ -89,50 +88,111 @@ class Face(object):
         gci = FT.FT_Get_Char_Index
         return [gci(self, c) for c in chars]
 
-
+    def glyph_indices(self, chars):
+        """
+        Return the glyph index of each of chars, which are glyph names or char
+        codes. Each is only ever looked up in FreeType once per face.
+
+        """
+        indices = self._indices
+        missing = [c for c in set(chars) if c not in indices]
+        if missing:
+            names = [c for c in missing if isinstance(c, basestring)]
+            codes = [c for c in missing if not isinstance(c, basestring)]
+            indices.update(itertools.izip(names, self.get_name_index(names)))
+            indices.update(itertools.izip(codes, self.get_char_index(codes)))
+        return [indices[c] for c in chars]
+
+    @property
+    def font_face(self):
+        """The face as a pycairo FontFace"""
+        if self._font_face is None:
+            # pycairo can't wrap a cairo_font_face_t itself, so set it on a
+            # scratch context and have pycairo hand it back
+            cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+            cr_p = pycairo_context.from_address(id(cr)).ctx
+            CAIRO.cairo_set_font_face(cr_p, self._cairoface)
+            self._font_face = cr.get_font_face()
+        return self._font_face
 
     def set_cairo_font(self, cr, size):
-        ref_cr, cr_p = Face._context
-        if ref_cr is not cr:
-            ref_cr, cr_p = Face._context =\
-                    cr, pycairo_context.from_address(id(cr)).ctx
-
-        CAIRO.cairo_set_font_face(cr_p, self._cairoface)
+        cr.set_font_face(self.font_face)
         cr.set_font_size(size)
 
-first = operator.itemgetter(0)
-fifth = operator.itemgetter(4)
-
-
 class TextRenderer(object):
-    def __init__(self):
+    def __init__(self, max_fonts=1024):
         self._faces = {}
+        # (filename, size, surface type, CTM) -> cairo.ScaledFont
+        self._scaled = {}
+        self.max_fonts = max_fonts
 
     def load(self, name):
-        face = self._faces.get(name) or Face(name)
-        self._faces[name] = face
-        face.select_charmap(ADOBE_CUSTOM)
+        face = self._faces.get(name)
+        if face is None:
+            face = self._faces[name] = Face(name)
+            face.select_charmap(ADOBE_CUSTOM)
         return face
 
-    def render(self, cr, dvi, groupby=itertools.groupby):
-        # This is fucked!
-        for op, xs in groupby(dvi[0], key=first):
-            if op == 'c':
-                for font, chars in groupby(xs, key=fifth):
-                    fn, fs = font
-                    face = self.load(fn)
-                    face.set_cairo_font(cr, fs)
-                    _, x, y, c, __ = zip(*chars)
-
-                    try:
-                        c = face.get_name_index(c)
-                    except:
-                        c = face.get_char_index(c)
-
-                    cr.show_glyphs(zip(c, x, y))
-
-            elif op == 'r':
-                for _, x0, y0, dx, dy in xs:
-                    cr.rectangle(x0, y0, dx, -dy)
-                    cr.fill()
-                # do the rule thingy here
+    def set_font(self, cr, name, size):
+        """Set the scaled font for the named face at the given size on cr"""
+        xx, yx, xy, yy, x0, y0 = cr.get_matrix()
+        target = cr.get_target()
+        # Only the linear part of the CTM matters to a scaled font. The font
+        # options are the surface's, with any set on cr on top, as cairo would
+        # use if the font was set on cr by face and size.
+        options = target.get_font_options()
+        options.merge(cr.get_font_options())
+        key = name, size, type(target), options.hash(), xx, yx, xy, yy
+        font = self._scaled.get(key)
+        if font is None:
+            if len(self._scaled) >= self.max_fonts:
+                self._scaled.clear()
+            font = self._scaled[key] = cairo.ScaledFont(
+                self.load(name).font_face,
+                cairo.Matrix(size, 0, 0, size, 0, 0),
+                cairo.Matrix(xx, yx, xy, yy, 0, 0),
+                options)
+        cr.set_scaled_font(font)
+
+    def glyph_ids(self, page):
+        """Return the FreeType glyph index of each entry of the glyph table"""
+        # The entries of each font, in one pass over the table
+        entries = {}
+        for i, (font, _) in enumerate(page.glyphs):
+            entries.setdefault(font, []).append(i)
+
+        ids = [0] * len(page.glyphs)
+        for font, indices in entries.iteritems():
+            fn, fs = page.fonts[font]
+            c = self.load(fn).glyph_indices([page.glyphs[i][1] for i in indices])
+            for i, g in itertools.izip(indices, c):
+                ids[i] = g
+        return ids
+
+    def glyph_runs(self, page):
+        """
+        Yield (filename, size, glyphs) for each run of glyphs in the same font,
+        glyphs being (index, x, y) as show_glyphs takes them.
+
+        """
+        ids = self.glyph_ids(page)
+        x, y, glyph = page.x, page.y, page.glyph
+        for font, start, end in page.runs():
+            fn, fs = page.fonts[font]
+            yield fn, fs, zip([ids[g] for g in glyph[start:end]],
+                              x[start:end], y[start:end])
+
+    def show_glyphs(self, cr, name, size, glyphs):
+        self.set_font(cr, name, size)
+        cr.show_glyphs(glyphs)
+
+    def render_rules(self, cr, page):
+        rules = page.rules
+        for i in xrange(0, len(rules), 4):
+            cr.rectangle(rules[i], rules[i + 1], rules[i + 2], -rules[i + 3])
+            cr.fill()
+
+    def render(self, cr, page):
+        for fn, fs, glyphs in self.glyph_runs(page):
+            self.show_glyphs(cr, fn, fs, glyphs)
+        self.render_rules(cr, page)
@@ -0,0 +1,211 @@
+# Saving many pictures at once, spread over several worker processes. Each
+# worker holds on to its own backend, TeX daemon and text renderer for as long
+# as it lives, so LaTeX is started and fonts are loaded once per worker, not
+# once per figure. Pictures are pickled on their way to the workers (see
+# Picture.__getstate__), and pick up the worker's backend when unpickled.
+#
+# Every worker has an inbox of its own, so the parent always knows which jobs
+# a worker has taken on. If one dies, the job it was on fails, the jobs queued
+# behind it go back to the others, and a new worker takes its place. Results
+# come back on a pipe of each worker's own, written to straight away: a worker
+# dying mid-send can't leave a shared queue's lock held, stopping the others,
+# or lose a result its queue hadn't got round to sending.
+#
+# Workers aren't forked from the parent where Python can help it. The parent
+# may well have a TexDaemon, with its threads, and the inboxes have feeder
+# threads of their own; forking while one of them holds a lock leaves the
+# child stuck on it. Python 2 can only fork, so there the first workers are
+# at least started before anything is put on a queue.
+
+import time
+import select
+import collections
+import multiprocessing
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# The default dependencies, for workers that don't inherit them
+import core
+from deps import depman
+
+
+# What became of a job: its targets, the seconds the worker spent on it (None
+# if it never got that far), the worker's pid, and an error message or None
+Result = collections.namedtuple('Result', 'targets seconds worker error')
+
+
+def dumps(job, dumps=pickle.dumps):
+    return dumps(job, pickle.HIGHEST_PROTOCOL)
+
+
+def _context():
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return get_context('forkserver')
+    return get_context('spawn')
+
+
+def _error(e):
+    return '%s: %s' % (type(e).__name__, e)
+
+
+def _work(inbox, outbox, loads=pickle.loads,
+          deps=('backend', 'texdaemon', 'textrenderer')):
+    # Anything made before the fork belongs to the parent
+    depman.forget()
+    # depman only keeps weak references, so keep these alive between figures.
+    # Any that can't be made are left to fail, with their error, in the jobs
+    warm = []
+    for dep in deps:
+        try:
+            warm.append(depman.get(dep))
+        except Exception:
+            pass
+    while True:
+        job = inbox.get()
+        if job is None:
+            break
+
+        i, data = job
+        t0 = time.time()
+        try:
+            pic, targets = loads(data)
+            if not isinstance(targets, list):
+                targets = [targets]
+            pic.save_many(targets)
+            error = None
+        except Exception as e:
+            error = _error(e)
+        outbox.send((i, time.time() - t0, error))
+
+    for dep in warm:
+        join = getattr(dep, 'join', None)
+        if join is not None:
+            join()
+
+
+class _Worker(object):
+    def __init__(self, context):
+        self.inbox = context.Queue()
+        self.outbox, outbox = context.Pipe(duplex=False)
+        # The jobs handed over and not yet reported, oldest first
+        self.pending = collections.deque()
+        self.process = context.Process(target=_work, args=(self.inbox, outbox))
+        self.process.daemon = True
+        self.process.start()
+        # Only the worker writes to it, so reading finds the end once it's gone
+        outbox.close()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def fileno(self):
+        # For select
+        return self.outbox.fileno()
+
+    def receive(self):
+        """Return the (job, seconds, error) of each result sent so far"""
+        results = []
+        try:
+            while self.outbox.poll():
+                results.append(self.outbox.recv())
+        except (EOFError, IOError):
+            pass
+        return results
+
+    def stop(self, timeout=None):
+        self.inbox.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.outbox.close()
+
+    def abandon(self):
+        # Don't wait on a dead worker to read what's still in its inbox
+        self.inbox.cancel_join_thread()
+        self.inbox.close()
+        self.outbox.close()
+
+
+def export_many(jobs, processes=None, prefetch=2, poll=0.5, dumps=dumps):
+    """
+    Save many pictures using `processes` worker processes, one per CPU by
+    default. `jobs` are (picture, targets) pairs, `targets` being a target as
+    taken by Picture.save_many, or a list of them. Return a Result for every
+    job, in order.
+
+    Each worker is kept `prefetch` jobs ahead. Should a worker die, the job
+    it was on fails and a new worker is started in its place. Where workers
+    aren't forked, they import the main module, so a script calling this
+    needs the usual `if __name__ == '__main__'` guard.
+
+    """
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    todo = collections.deque()
+
+    for i, job in enumerate(jobs):
+        try:
+            todo.append((i, dumps(job)))
+        except Exception as e:
+            results[i] = Result(job[1], None, None, _error(e))
+
+    left = len(todo)
+    if not left:
+        return results
+
+    context = _context()
+    n = min(processes or multiprocessing.cpu_count(), left)
+    workers = {}
+    try:
+        for _ in xrange(n):
+            w = _Worker(context)
+            workers[w.pid] = w
+
+        while left:
+            for w in workers.itervalues():
+                while todo and len(w.pending) < prefetch:
+                    i, data = todo.popleft()
+                    w.inbox.put((i, data))
+                    w.pending.append((i, data))
+
+            ready, _, _ = select.select(workers.values(), [], [], poll)
+            # A worker can die while the others keep reporting, so look every
+            # time round. Whatever the dead managed to send is in their pipes.
+            dead = [w for w in workers.itervalues() if not w.process.is_alive()]
+
+            for w in set(ready).union(dead):
+                for i, seconds, error in w.receive():
+                    w.pending.popleft()
+                    results[i] = Result(jobs[i][1], seconds, w.pid, error)
+                    left -= 1
+
+            for w in dead:
+                w.abandon()
+                del workers[w.pid]
+                if w.pending:
+                    i, _ = w.pending.popleft()
+                    results[i] = Result(jobs[i][1], None, w.pid,
+                                        'worker died with exit code %s' %
+                                        w.process.exitcode)
+                    left -= 1
+                    todo.extendleft(reversed(w.pending))
+                if left:
+                    w = _Worker(context)
+                    workers[w.pid] = w
+    finally:
+        for w in workers.itervalues():
+            w.stop(timeout=poll)
+
+    return results
@@ -0,0 +1,632 @@
+# Benchmarks for the hot paths. Each takes its inputs from the command line,
+# e.g.
+#
+#     python benchmarks.py dvi some-large-file.dvi
+
+import os
+import sys
+import time
+import random
+import itertools
+import subprocess
+from array import array
+
+import tex
+
+
+def best_of(f, repeat=5, timer=time.time):
+    """Return the best wall-clock time of `repeat` calls to f"""
+    best = None
+    for _ in xrange(repeat):
+        t0 = timer()
+        f()
+        t = timer() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def memo_font():
+    """
+    A Font for the dispatchers that only loads each font once, so that font
+    loading doesn't swamp the DVI decoding being measured.
+
+    """
+    fonts = {}
+    def Font(name, s, d, k):
+        key = name, s, d
+        font = fonts.get(key)
+        if font is None:
+            font = fonts[key] = tex.FontMetrics(name, s, d, k)
+        return font
+    return Font
+
+
+def read_dvi(dispatcher, stream):
+    """Read a whole DVI file with no handler attached. Return the page count"""
+    read_pre = dispatcher.reader(whitelist=['pre', 'nop'], end_on=['pre'])
+    read_bop = dispatcher.reader(whitelist=['bop', 'nop', 'fnt_def'],
+                                 end_on=['bop'])
+    read_eop = dispatcher.reader(blacklist=['pre', 'post', 'post_post'],
+                                 end_on=['eop'])
+    state = tex.DviState()
+    read_pre(stream, state)
+    pages = 0
+    while True:
+        try:
+            read_bop(stream, state)
+        except RuntimeError:
+            # Ran into the postamble
+            return pages
+        read_eop(stream, state)
+        pages += 1
+
+
+def bench_dvi(filename):
+    """Compare the byte iterator DVI reader with the buffer reader"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    Font = memo_font()
+    old = tex.dvi_ops(tex.unsigned, tex.signed, tex.read_string, Font=Font)
+    new = tex.dvi_ops(tex.buf_unsigned, tex.buf_signed, tex.buf_read_string,
+                      buffered=True, Font=Font)
+
+    # Fed in chunks, just as read_output sees the DVI coming out of LaTeX
+    chunks = [data[i:i + 8192] for i in xrange(0, len(data), 8192)]
+    def old_stream():
+        return itertools.chain.from_iterable(bytearray(i) for i in chunks)
+    def new_stream():
+        return tex.ByteBuffer(source=chunks)
+
+    pages = read_dvi(old, old_stream())
+    t_old = best_of(lambda: read_dvi(old, old_stream()))
+    t_new = best_of(lambda: read_dvi(new, new_stream()))
+
+    print('%d bytes, %d pages' % (len(data), pages))
+    print('iterator reader: %8.2f ms' % (1000 * t_old))
+    print('buffer reader:   %8.2f ms (%.1fx)' % (1000 * t_new, t_old / t_new))
+
+
+class _Font(object):
+    bc = 0
+    widths = array('i', [65536] * 256)
+    chars = tex.CharMetrics(bc, widths, array('i', [0] * 256),
+                            array('i', [0] * 256))
+
+
+def bench_dispatch(lines=20000):
+    """
+    Opcodes per second through each of the DVI readers, on a synthetic page of
+    typical text: characters, word spaces, pushes and pops, and font changes.
+
+    """
+    lines = int(lines)
+    word = bytearray('plotting')
+    line = (bytearray([141]) + (word + bytearray([147])) * 8 +
+            bytearray([171, 143, 4]) + word + bytearray([172, 142]) +
+            bytearray([161]))
+    ops = 1 + 8 * (len(word) + 1) + 2 + len(word) + 2 + 1
+    page = bytearray([148, 0, 161, 0]) + line * lines + bytearray([140])
+    ops = ops * lines + 3
+
+    state = tex.DviState()
+    state.fonts = {0: _Font(), 1: _Font()}
+    state.font = state.fonts[0]
+
+    def blacklisted(dispatcher, **kwargs):
+        return dispatcher.reader(blacklist=['pre', 'post', 'post_post'],
+                                 end_on=['eop'], **kwargs)
+
+    readers = [
+        ('iterator', blacklisted(tex.dvi), lambda: iter(page)),
+        ('buffer', blacklisted(tex.dvi_buffer, compiled=False),
+         lambda: tex.ByteBuffer(page)),
+        ('table', blacklisted(tex.dvi_buffer), lambda: tex.ByteBuffer(page)),
+    ]
+
+    print('%d opcodes' % ops)
+    for name, reader, stream in readers:
+        t = best_of(lambda: reader(stream(), state))
+        print('%-10s %10.0f opcodes/s' % (name, ops / t))
+
+
+def bench_import(repeat=10):
+    """
+    Time fresh interpreters importing core and tex, over and above the time the
+    interpreter takes to start, and the cost of the first use of the fontmap.
+
+    """
+    repeat = int(repeat)
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code):
+        t0 = time.time()
+        for _ in xrange(repeat):
+            subprocess.check_call([sys.executable, '-c', code], cwd=here)
+        return (time.time() - t0) / repeat
+
+    base = run('pass')
+    print('interpreter start-up: %8.2f ms' % (1000 * base))
+    for code in ['import core',
+                 'import tex',
+                 'import tex; tex.fontmap.mapping']:
+        print('%-32s %8.2f ms' % (code, 1000 * (run(code) - base)))
+
+
+def bench_tfm(*fonts):
+    """
+    Check that the NumPy TFM decoding is bit-identical to the scalar decoding,
+    over many scale factors, for each of the given fonts (names or paths). Then
+    time the two.
+
+    """
+    if tex.np is None:
+        sys.exit('NumPy is not available')
+
+    filenames = [f if os.path.exists(f) else tex.kpsewhich('%s.tfm' % f)
+                 for f in fonts or ('cmr10', 'cmmi10', 'pplr8r', 'zplmr7t')]
+    filenames = [f for f in filenames if f]
+
+    rng = random.Random(0)
+    scales = [1, 2, 0o37777777, 0o40000000, 0o40000001, 0o177777777]
+    scales += [rng.randrange(1, 1 << 27) for _ in xrange(200)]
+
+    for filename in filenames:
+        for scale in scales:
+            d = rng.randrange(1, 1 << 24)
+            scalar = tex.read_tfm(filename, scale, d, vectorize=False)
+            vector = tex.read_tfm(filename, scale, d)
+            if scalar != vector:
+                sys.exit('%s differs at scale %d' % (filename, scale))
+
+        t_scalar = best_of(lambda: tex.read_tfm(filename, 655360, 655360,
+                                                vectorize=False))
+        t_vector = best_of(lambda: tex.read_tfm(filename, 655360, 655360))
+        print('%s: identical at %d scales; scalar %.2f ms, numpy %.2f ms' % (
+            os.path.basename(filename), len(scales),
+            1000 * t_scalar, 1000 * t_vector))
+
+
+def bench_metrics(*fonts):
+    """
+    Per-font memory and glyph advance throughput of the font metrics, as the
+    old dict of tuples and as CharMetrics.
+
+    """
+    filenames = [f if os.path.exists(f) else tex.kpsewhich('%s.tfm' % f)
+                 for f in fonts or ('cmr10', 'pplr8r')]
+
+    for filename in filter(None, filenames):
+        size, bc, ws, hs, ds = tex.read_tfm(filename, 655360, 655360)
+        old = dict(itertools.izip(xrange(bc, bc + len(ws)),
+                                  itertools.izip(ws, hs, ds)))
+        new = tex.CharMetrics(bc, ws, hs, ds)
+
+        old_bytes = sys.getsizeof(old) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) + sum(map(sys.getsizeof, v))
+            for k, v in old.iteritems())
+        new_bytes = sys.getsizeof(new) + sum(map(sys.getsizeof, (ws, hs, ds)))
+
+        rng = random.Random(0)
+        codes = [rng.randrange(bc, bc + len(ws)) for _ in xrange(100000)]
+
+        def dict_advance():
+            h = 0
+            for i in codes:
+                h += old[i][0]
+            return h
+
+        def array_advance():
+            h = 0
+            widths = new.widths
+            for i in codes:
+                h += widths[i - bc]
+            return h
+
+        t_old = best_of(dict_advance)
+        t_new = best_of(array_advance)
+        print('%s: %d chars' % (os.path.basename(filename), len(ws)))
+        print('  dict of tuples: %7d bytes %12.0f glyphs/s' % (
+            old_bytes, len(codes) / t_old))
+        print('  CharMetrics:    %7d bytes %12.0f glyphs/s' % (
+            new_bytes, len(codes) / t_new))
+
+
+def bench_labels(labels=300):
+    """
+    Time saving a PDF of many small TeX labels, and compare its size, with and
+    without text batching in the renderer.
+
+    """
+    import tempfile
+    import core
+    from cairobackend import CairoBackend
+
+    labels = int(labels)
+    rng = random.Random(0)
+    pic = core.Picture()
+    for i in xrange(labels):
+        pic.shift(rng.uniform(0, 500), rng.uniform(0, 500)).tex(str(i))
+
+    fd, filename = tempfile.mkstemp(suffix='.pdf')
+    os.close(fd)
+    try:
+        for batch_text in (False, True):
+            backend = CairoBackend(batch_text=batch_text)
+            backend.save(pic, filename, 'pdf')  # Typesets everything
+            t = best_of(lambda: backend.save(pic, filename, 'pdf'))
+            print('batch_text=%-5s %8.2f ms %8d bytes' % (
+                batch_text, 1000 * t, os.path.getsize(filename)))
+    finally:
+        os.remove(filename)
+
+
+def bench_picture(segments=200000):
+    """
+    Memory and replay speed of a picture of many line segments, stored as the
+    compact command buffer and as the old list of tuples.
+
+    """
+    from core import Picture
+    from picture import OPS
+
+    segments = int(segments)
+    rng = random.Random(0)
+    t0 = time.time()
+    pic = Picture().move_to(0, 0)
+    for i in xrange(segments):
+        pic.line_to(i, rng.random())
+    pic.stroke()
+    t_build = time.time() - t0
+    # As they used to be kept
+    commands = list(pic.commands)
+
+    new_bytes = sum(map(sys.getsizeof, (pic._ops, pic._args, pic._objs)))
+    old_bytes = sys.getsizeof(commands) + sum(
+        sys.getsizeof(c) + sum(map(sys.getsizeof, c[1:])) for c in commands)
+
+    class Replayer(object):
+        def draw_move_to(self, x, y): pass
+        def draw_line_to(self, x, y): pass
+        def draw_stroke(self): pass
+
+        def draw(self, op, args):
+            return getattr(self, 'draw_%s' % op)(*args)
+
+    r = Replayer()
+    handlers = [getattr(r, 'draw_%s' % name, None) for name, _, _ in OPS]
+
+    def old_replay():
+        for op, arg in ((x[0], x[1:]) for x in commands):
+            r.draw(op, arg)
+
+    t_old = best_of(old_replay)
+    t_new = best_of(lambda: pic.replay(handlers))
+    print('%d commands, built in %.2f ms' % (len(commands), 1000 * t_build))
+    print('list of tuples:  %10d bytes %8.2f ms replay' % (
+        old_bytes, 1000 * t_old))
+    print('command buffer:  %10d bytes %8.2f ms replay' % (
+        new_bytes, 1000 * t_new))
+
+
+def bench_series(points=200000):
+    """
+    Build and draw a time series of many points, as move_to and line_to calls
+    and as a single polyline, against a context that does nothing.
+
+    """
+    import numpy as np
+    from core import Picture
+    from cairobackend import CairoRenderer
+
+    points = int(points)
+    xs = np.arange(points, dtype=float)
+    ys = np.random.RandomState(0).standard_normal(points).cumsum()
+
+    class Context(object):
+        def save(self): pass
+        def restore(self): pass
+        def move_to(self, x, y): pass
+        def line_to(self, x, y): pass
+        def stroke(self): pass
+
+    renderer = CairoRenderer(Context())
+
+    def segments():
+        pic = Picture().move_to(xs[0], ys[0])
+        for x, y in itertools.izip(xs.tolist(), ys.tolist()):
+            pic.line_to(x, y)
+        return pic.stroke()
+
+    def polyline():
+        return Picture().polyline(xs, ys).stroke()
+
+    for name, build in [('line_to', segments), ('polyline', polyline)]:
+        pic = build()
+        t_build = best_of(build, repeat=3)
+        t_draw = best_of(lambda: renderer.draw_picture(pic), repeat=3)
+        print('%-10s build %8.2f ms, draw %8.2f ms' % (
+            name, 1000 * t_build, 1000 * t_draw))
+
+
+def bench_decimate(points=1000000, width=1000, tol=0.5):
+    """
+    Decimate a random walk of many points drawn `width` device units wide.
+    Report how many points are left and how long it took, and check that the
+    error bound holds: every column keeps its first, last, lowest and highest
+    points.
+
+    """
+    import numpy as np
+    import decimate
+
+    points = int(points)
+    width = float(width)
+    tol = float(tol)
+    xs = np.arange(points, dtype=float)
+    ys = np.random.RandomState(0).standard_normal(points).cumsum()
+    matrix = width / points, 0, 0, -1, 0, 0
+
+    t = best_of(lambda: decimate.decimate(xs, ys, matrix, tol), repeat=3)
+    dxs, dys = decimate.decimate(xs, ys, matrix, tol)
+    print('%d points -> %d in %.2f ms' % (points, len(dxs), 1000 * t))
+
+    col = np.floor(xs * matrix[0] / tol)
+    dcol = np.floor(dxs * matrix[0] / tol)
+    starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+    dstarts = np.flatnonzero(np.r_[True, dcol[1:] != dcol[:-1]])
+    for reduce in (np.minimum, np.maximum):
+        if not np.array_equal(reduce.reduceat(ys, starts),
+                              reduce.reduceat(dys, dstarts)):
+            sys.exit('decimated line leaves the envelope of the original')
+    if not np.array_equal(col[starts], dcol[dstarts]):
+        sys.exit('decimated line lost a column')
+    print('error bound holds')
+
+
+def random_picture(rng, commands, pic=None, depth=0):
+    """A picture of random paths, strokes, fills and transformations"""
+    import numpy as np
+    from core import Picture
+
+    pic = Picture() if pic is None else pic
+    n = 0
+    while n < commands:
+        c = rng.random()
+        if c < 0.05 and depth < 3:
+            sub = rng.choice([lambda: pic.shift(rng.uniform(-50, 50),
+                                                rng.uniform(-50, 50)),
+                              lambda: pic.rotate(rng.uniform(0, 360)),
+                              lambda: pic.scale(rng.uniform(0.2, 3),
+                                                rng.uniform(0.2, 3))])()
+            random_picture(rng, commands // 10, sub, depth + 1)
+            n += commands // 10
+            continue
+        elif c < 0.1:
+            pic.linewidth(rng.uniform(0, 5))
+            pic.linecap(rng.choice(['butt', 'round', 'square']))
+            pic.linejoin(rng.choice(['miter', 'round', 'bevel']))
+        elif c < 0.5:
+            pic.move_to(rng.uniform(-100, 100), rng.uniform(-100, 100))
+            for _ in xrange(rng.randrange(1, 10)):
+                pic.line_to(rng.uniform(-100, 100), rng.uniform(-100, 100))
+        elif c < 0.7:
+            pic.rectangle(rng.uniform(-100, 100), rng.uniform(-100, 100),
+                          rng.uniform(-20, 20), rng.uniform(-20, 20))
+        elif c < 0.8:
+            k = rng.randrange(2, 200)
+            pic.polyline(np.linspace(rng.uniform(-100, 0), rng.uniform(0, 100), k),
+                         np.random.RandomState(n).standard_normal(k).cumsum())
+        else:
+            rng.choice([pic.stroke, pic.fill])()
+        n += 1
+    return pic.stroke()
+
+
+def ink_extents(recording):
+    """
+    The extents of the pixels a recording surface really covers. The surface's
+    own ink_extents are worked out without drawing anything, and can be
+    several units too big.
+
+    """
+    import math
+    import cairo
+    import numpy as np
+
+    x, y, w, h = recording.ink_extents()
+    x, y = int(math.floor(x)), int(math.floor(y))
+    w, h = int(math.ceil(w)) + 2, int(math.ceil(h)) + 2
+    img = cairo.ImageSurface(cairo.FORMAT_A8, w, h)
+    cr = cairo.Context(img)
+    cr.set_source_surface(recording, -x, -y)
+    cr.paint()
+    img.flush()
+    a = np.frombuffer(img.get_data(), np.uint8)
+    ys, xs = np.nonzero(a.reshape(h, img.get_stride())[:, :w])
+    return x + xs.min(), y + ys.min(), x + xs.max() + 1, y + ys.max() + 1
+
+
+def bench_extents(pictures=20, commands=2000):
+    """
+    Check GeometrySizer against the ink cairo draws for random pictures, and
+    compare it with CairoSizer for speed and tightness.
+
+    """
+    import cairo
+    from cairobackend import CairoRenderer, CairoSizer, GeometrySizer
+
+    def area(e):
+        return (e[2] - e[0]) * (e[3] - e[1])
+
+    rng = random.Random(0)
+    t_cairo = t_geometry = 0
+    slack = []
+    for _ in xrange(int(pictures)):
+        pic = random_picture(rng, int(commands))
+
+        surf = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+        CairoRenderer(cairo.Context(surf)).render(pic)
+        ink = ink_extents(surf)
+
+        def geometry():
+            g = GeometrySizer()
+            g.size_picture(pic)
+            return g.extents
+
+        def old():
+            c = CairoSizer()
+            c.size_picture(pic)
+            return c.extents
+
+        t_geometry += best_of(geometry, repeat=3)
+        t_cairo += best_of(old, repeat=3)
+        e = geometry()
+        # Ink extents are rounded out to whole pixels
+        if (e[0] > ink[0] + 1 or e[1] > ink[1] + 1 or
+                e[2] < ink[2] - 1 or e[3] < ink[3] - 1):
+            sys.exit('extents %r miss ink at %r' % (e, ink))
+        slack.append(area(e) / area(ink))
+
+    print('all %d pictures contained; area vs ink: mean %.3f, worst %.3f' % (
+        len(slack), sum(slack) / len(slack), max(slack)))
+    print('CairoSizer:    %8.2f ms' % (1000 * t_cairo))
+    print('GeometrySizer: %8.2f ms' % (1000 * t_geometry))
+
+
+def bench_frozen(uses=500, commands=200):
+    """
+    Save and size a picture which uses one subpicture many times, with the
+    subpicture as it is and frozen.
+
+    """
+    import tempfile
+    import core
+    from cairobackend import CairoBackend
+
+    rng = random.Random(0)
+    sub = random_picture(rng, int(commands), depth=3)
+    offsets = [(rng.uniform(0, 500), rng.uniform(0, 500))
+               for _ in xrange(int(uses))]
+
+    fd, filename = tempfile.mkstemp(suffix='.pdf')
+    os.close(fd)
+    try:
+        for name, used in [('plain', sub), ('frozen', sub.freeze())]:
+            pic = core.Picture()
+            for x, y in offsets:
+                pic.shift(x, y).picture(used)
+            backend = CairoBackend()
+            t_save = best_of(lambda: backend.save(pic, filename, 'pdf'))
+            t_size = best_of(lambda: backend.size(pic))
+            print('%-7s save %8.2f ms %8d bytes, size %8.2f ms' % (
+                name, 1000 * t_save, os.path.getsize(filename),
+                1000 * t_size))
+    finally:
+        os.remove(filename)
+
+
+def bench_batch(figures=200, commands=2000, processes=None):
+    """
+    Save many random pictures one after another, and then with
+    batch.export_many, and show how the per-figure times spread.
+
+    """
+    import shutil
+    import tempfile
+    import batch
+
+    rng = random.Random(0)
+    pics = [random_picture(rng, int(commands)) for _ in xrange(int(figures))]
+    tmp = tempfile.mkdtemp()
+    try:
+        jobs = [(pic, os.path.join(tmp, '%d.pdf' % i))
+                for i, pic in enumerate(pics)]
+
+        t0 = time.time()
+        for pic, filename in jobs:
+            pic.save(filename)
+        t_loop = time.time() - t0
+
+        t0 = time.time()
+        results = batch.export_many(jobs, processes and int(processes))
+        t_batch = time.time() - t0
+    finally:
+        shutil.rmtree(tmp)
+
+    failed = [r for r in results if r.error]
+    if failed:
+        sys.exit('%d figures failed, e.g. %s' % (len(failed), failed[0].error))
+    times = sorted(r.seconds for r in results)
+    print('loop:  %8.2f s' % t_loop)
+    print('batch: %8.2f s on %d workers' % (
+        t_batch, len(set(r.worker for r in results))))
+    print('per figure: median %.1f ms, worst %.1f ms' % (
+        1000 * times[len(times) // 2], 1000 * times[-1]))
+
+
+def bench_picturefile(series=50, points=100000):
+    """
+    Save and load a picture of long polylines with picturefile, and with
+    pickle for comparison.
+
+    """
+    import tempfile
+    import pickle
+    import numpy as np
+    import core
+    import picturefile
+
+    rng = np.random.RandomState(0)
+    pic = core.Picture()
+    xs = np.linspace(0, 1000, int(points))
+    for _ in xrange(int(series)):
+        pic.polyline(xs, rng.standard_normal(int(points)).cumsum())
+    pic.stroke()
+
+    fd, filename = tempfile.mkstemp(suffix='.plpy')
+    os.close(fd)
+    try:
+        t_dump = best_of(lambda: picturefile.dump(pic, filename))
+        t_load = best_of(lambda: picturefile.load(filename))
+        loaded = picturefile.load(filename).commands
+        for a, b in zip(loaded, pic.commands):
+            if a[0] != b[0] or not all(np.array_equal(x, y)
+                                       for x, y in zip(a[1:], b[1:])):
+                sys.exit('picture changed on its way through a file')
+        size = os.path.getsize(filename)
+    finally:
+        os.remove(filename)
+
+    data = pickle.dumps(pic, pickle.HIGHEST_PROTOCOL)
+    t_pickle = best_of(lambda: pickle.dumps(pic, pickle.HIGHEST_PROTOCOL))
+    t_unpickle = best_of(lambda: pickle.loads(data))
+
+    print('picturefile: %10d bytes, dump %8.2f ms, load %8.2f ms' % (
+        size, 1000 * t_dump, 1000 * t_load))
+    print('pickle:      %10d bytes, dump %8.2f ms, load %8.2f ms' % (
+        len(data), 1000 * t_pickle, 1000 * t_unpickle))
+
+
+BENCHMARKS = {
+    'dvi': bench_dvi,
+    'dispatch': bench_dispatch,
+    'import': bench_import,
+    'tfm': bench_tfm,
+    'metrics': bench_metrics,
+    'labels': bench_labels,
+    'picture': bench_picture,
+    'series': bench_series,
+    'decimate': bench_decimate,
+    'extents': bench_extents,
+    'frozen': bench_frozen,
+    'batch': bench_batch,
+    'picturefile': bench_picturefile,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        sys.exit('usage: %s {%s} [args...]' % (
+            sys.argv[0], ','.join(sorted(BENCHMARKS))))
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -1,5 +1,7 @@
+import os
 import math
 import itertools
+import collections
 import cairo
 
 # We could quite easily simplify most of this by using a 'new' (2010)
@@ -10,8 +12,85 @@ import cairo
 # of using this on really old and outdated systems.
 
 from deps import depman
+from picture import OPS, OPCODES, FrozenPicture
+from decimate import decimate
+
+TEX = OPCODES['tex']
+PICTURE = OPCODES['picture']
+
+
+def typeset(texd, pages, picture):
+    """
+    Typeset every TeX snippet in the picture not already in `pages`, in a
+    single batch, and add them to it.
+
+    """
+    texs = []
+    seen = set(pages)
+    for tex in tex_snippets(picture):
+        if tex not in seen:
+            seen.add(tex)
+            texs.append(tex)
+
+    if texs:
+        pages.update(zip(texs, texd.page_many(texs)))
+    return pages
+
+
+def values(xs):
+    """Return xs as a list of plain floats, as cheaply as possible"""
+    tolist = getattr(xs, 'tolist', None)
+    return tolist() if tolist is not None else list(xs)
+
+
+def bounds(xs):
+    """Return the min and max of xs, vectorised if xs is a NumPy array"""
+    if hasattr(xs, 'min'):
+        return float(xs.min()), float(xs.max())
+    return min(xs), max(xs)
+
+
+def tex_snippets(picture):
+    """
+    Yield every TeX snippet in a picture and its subpictures. Subpictures that
+    are used more than once are only visited once.
+
+    """
+    seen = set()
+    stack = [picture]
+    while stack:
+        pic = stack.pop()
+        if id(pic) in seen:
+            continue
+        seen.add(id(pic))
+        for op, obj in pic.objects():
+            if op == TEX:
+                yield obj
+            elif op == PICTURE:
+                stack.append(obj)
+
 
 class CairoBackend(object):
+    def __init__(self, max_pages=4096, batch_text=False, decimate=None):
+        # Typeset pages, shared between size() and save() so that a picture is
+        # only ever typeset once
+        self.pages = {}
+        self.max_pages = max_pages
+        # See CairoRenderer
+        self.batch_text = batch_text
+        self.decimate = decimate
+
+    def _pages(self):
+        if len(self.pages) > self.max_pages:
+            self.pages.clear()
+        return self.pages
+
+    def renderer(self, cr, pic):
+        """Return a CairoRenderer for `cr`, with all of `pic`'s TeX typeset"""
+        r = CairoRenderer(cr, pages=self._pages(), batch_text=self.batch_text,
+                          decimate=self.decimate)
+        r.typeset(pic)
+        return r
 
     def show(self, pic, block):
         pass
@@ -23,42 +102,202 @@ class CairoBackend(object):
     #        gui.show(pic, block)
     #        self.gui = gui
 
-    def save(self, pic, filename, filetype):
-        # Determine the filetype automatically from filename
-        #surf = cairo.ImageSurface(cairo.FORMAT_RGB24, 300, 300)
-        surf = cairo.PDFSurface(filename, 300, 300)
-        cr = cairo.Context(surf)
-        #cr.save()
-        #cr.set_source_rgb(1,1,1)
-        #cr.paint()
-        #cr.restore()
-        CairoRenderer(cr).draw_picture(pic)
-        #surf.write_to_png(filename)
-        surf.finish()
+    filetypes = ('pdf', 'svg', 'ps', 'eps', 'png')
+
+    def save(self, pic, filename, filetype=None):
+        self.save_many(pic, [(filename, filetype)])
+
+    def _target(self, target, dpi=72.0):
+        # filename, or (filename, filetype), or (filename, filetype, dpi)
+        if isinstance(target, basestring):
+            target = target,
+        filename = target[0]
+        filetype = (len(target) > 1 and target[1] or
+                    os.path.splitext(filename)[1][1:]).lower()
+        if len(target) > 2:
+            dpi = float(target[2])
+        if filetype not in self.filetypes:
+            raise ValueError('Unknown file type %r' % filetype)
+        return filename, filetype, dpi
+
+    def save_many(self, pic, targets):
+        """
+        Save the picture to every one of `targets`, each a filename, or a
+        (filename, filetype) or (filename, filetype, dpi) tuple. The filetype
+        is one of `filetypes`, taken from the filename's extension if not
+        given; dpi only matters to PNGs, and defaults to 72, a pixel a point.
+
+        The picture is sized, typeset and drawn once, into a recording, and
+        every file is painted from that. When decimating, though, each file is
+        drawn separately, so that its polylines are cut down to its own
+        resolution.
+
+        """
+        targets = [self._target(t) for t in targets]
+        x0, y0, x1, y1 = self.size(pic) or (0, 0, 0, 0)
+        width = max(x1 - x0, 1)
+        height = max(y1 - y0, 1)
+
+        if hasattr(cairo, 'RecordingSurface') and not self.decimate:
+            recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            self.renderer(cairo.Context(recording), pic).render(pic)
+            def paint(cr):
+                cr.set_source_surface(recording, -x0, -y0)
+                cr.paint()
+        else:
+            def paint(cr):
+                cr.translate(-x0, -y0)
+                self.renderer(cr, pic).render(pic)
+
+        for filename, filetype, dpi in targets:
+            if filetype == 'png':
+                scale = dpi / 72.0
+                surf = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                          int(math.ceil(width * scale)),
+                                          int(math.ceil(height * scale)))
+                cr = cairo.Context(surf)
+                cr.scale(scale, scale)
+                paint(cr)
+                surf.write_to_png(filename)
+                continue
+
+            if filetype == 'pdf':
+                surf = cairo.PDFSurface(filename, width, height)
+            elif filetype == 'svg':
+                surf = cairo.SVGSurface(filename, width, height)
+            else:
+                surf = cairo.PSSurface(filename, width, height)
+                surf.set_eps(filetype == 'eps')
+            paint(cairo.Context(surf))
+            surf.finish()
 
     def draw_to_context(self, pic, cr):
-        CairoRenderer(cr).draw_picture(pic)
+        self.renderer(cr, pic).render(pic)
 
     def size(self, picture):
-        c = CairoSizer()
+        c = GeometrySizer(pages=self._pages())
+        c.typeset(picture)
         c.size_picture(picture)
         return c.extents
 
 
 
 class CairoRenderer(object):
+    """
+    Draws pictures onto a cairo context.
+
+    With `batch_text`, the glyphs of every TeX snippet are held back and drawn
+    once the whole picture has been, with one show_glyphs per font, colour and
+    linear transform rather than one per snippet. That makes for far fewer
+    font switches and much smaller PDF and SVG output, but text always ends up
+    on top of everything else.
+
+    With `decimate`, polylines are cut down to the points that can be told
+    apart at the resolution of the target: no point is dropped that would be
+    more than `decimate` device units from the line drawn. See decimate.py.
+
+    """
     @depman.require(texd='texdaemon', textrenderer='textrenderer')
-    def __init__(self, cr, texd, textrenderer):
+    def __init__(self, cr, texd, textrenderer, pages=None, batch_text=False,
+                 decimate=None):
         self.texd = texd
         self.textrenderer = textrenderer
         self._cr = cr
+        self.pages = {} if pages is None else pages
+        self.batch = collections.OrderedDict() if batch_text else None
+        self.decimate = decimate
+        self.handlers = self._handlers('draw_')
+
+    def typeset(self, picture):
+        """
+        Typeset every TeX snippet in the picture up front, in a single batch,
+        so that drawing never has to wait on LaTeX.
+
+        """
+        return typeset(self.texd, self.pages, picture)
+
+    def render(self, picture):
+        """Draw the picture, and then any text held back"""
+        self.draw_picture(picture)
+        self.flush_text()
+
+    def _handlers(self, *prefixes):
+        """
+        Return the method for each opcode, in order, trying each prefix in turn.
+        Commands without one go through draw(), which complains about them.
+
+        """
+        def fallback(name):
+            return lambda *args: self.draw(name, args)
+
+        handlers = []
+        for name, _, _ in OPS:
+            for prefix in prefixes:
+                f = getattr(self, prefix + name, None)
+                if f is not None:
+                    break
+            handlers.append(f or fallback(name))
+        return handlers
+
+    def draw_command(self, command):
+        self.draw(command[0], command[1:])
 
     def draw_picture(self, picture):
+        if isinstance(picture, FrozenPicture):
+            return self.draw_frozen(picture)
         self._cr.save()
-        for op, arg in ((x[0], x[1:]) for x in picture.commands):
-            self.draw(op, arg)
+        picture.replay(self.handlers)
         self._cr.restore()
 
+    def draw_frozen(self, picture):
+        cr = self._cr
+        pattern = self.recording(picture)
+        if pattern is not None:
+            cr.save()
+            cr.set_source(pattern)
+            cr.paint()
+            cr.restore()
+            return
+
+        # Without recording surfaces, replay it just as it would have been
+        # recorded: from cairo's defaults, and with a path of its own
+        path = cr.copy_path()
+        cr.save()
+        cr.new_path()
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(2.0)
+        cr.set_line_cap(cairo.LINE_CAP_BUTT)
+        cr.set_line_join(cairo.LINE_JOIN_MITER)
+        picture.replay(self.handlers)
+        cr.new_path()
+        cr.restore()
+        cr.append_path(path)
+
+    def recording(self, picture):
+        """
+        Return a pattern that paints the frozen picture, recorded the first time
+        it is asked for, or None if it has to be replayed instead: when this
+        cairo can't record, or when decimating, since a recording is made
+        without knowing the resolution it will end up drawn at.
+
+        """
+        if self.decimate or not hasattr(cairo, 'RecordingSurface'):
+            return None
+
+        # Recordings with and without batched text differ
+        batch_text = self.batch is not None
+        key = 'recording', batch_text
+        pattern = picture.cache.get(key)
+        if pattern is None:
+            surf = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            r = CairoRenderer(cairo.Context(surf), texd=self.texd,
+                              textrenderer=self.textrenderer, pages=self.pages,
+                              batch_text=batch_text)
+            picture.replay(r.handlers)
+            r.flush_text()
+            pattern = picture.cache[key] = cairo.SurfacePattern(surf)
+        return pattern
+
 
     def draw_rectangle(self, x, y, w, h):
         self._cr.rectangle(x, y, w, h)
@@ -73,6 +312,47 @@ class CairoRenderer(object):
     def draw_line_to(self, x, y):
         self._cr.line_to(x, y)
 
+    def draw_polyline(self, xs, ys, decimate=decimate):
+        if self.decimate:
+            xs, ys = decimate(xs, ys, self._cr.get_matrix(), self.decimate)
+        xs = values(xs)
+        if not xs:
+            return
+        ys = values(ys)
+        line_to = self._cr.line_to
+        self._cr.move_to(xs[0], ys[0])
+        for x, y in itertools.islice(itertools.izip(xs, ys), 1, None):
+            line_to(x, y)
+
+    def draw_polygon(self, xs, ys):
+        self.draw_polyline(xs, ys)
+        self._cr.close_path()
+
+    def draw_markers(self, xs, ys, shape, size, tau=2 * math.pi):
+        cr = self._cr
+        s = size
+        points = itertools.izip(values(xs), values(ys))
+        if shape == 'circle':
+            for x, y in points:
+                cr.new_sub_path()
+                cr.arc(x, y, s, 0, tau)
+        elif shape == 'square':
+            for x, y in points:
+                cr.rectangle(x - s, y - s, 2 * s, 2 * s)
+        elif shape == 'diamond':
+            for x, y in points:
+                cr.move_to(x, y - s)
+                cr.line_to(x + s, y)
+                cr.line_to(x, y + s)
+                cr.line_to(x - s, y)
+                cr.close_path()
+        elif shape == 'triangle':
+            for x, y in points:
+                cr.move_to(x, y - s)
+                cr.line_to(x + s, y + s)
+                cr.line_to(x - s, y + s)
+                cr.close_path()
+
     def draw_move_to(self, x, y):
         self._cr.move_to(x, y)
 
@@ -120,8 +400,58 @@ class CairoRenderer(object):
         self._cr.fill_preserve()
 
     def draw_tex(self, tex, x, y):
-        status, glyphs = self.texd.page(tex)
-        self.textrenderer.render(self._cr, glyphs)
+        page = self.pages.get(tex)
+        if page is None:
+            page = self.pages[tex] = self.texd.page(tex)
+        status, page = page
+
+        cr = self._cr
+        cr.save()
+        cr.translate(x, y)
+        if self.batch is not None and self.batch_tex(page):
+            self.textrenderer.render_rules(cr, page)
+        else:
+            self.textrenderer.render(cr, page)
+        cr.restore()
+
+    def batch_tex(self, page):
+        """
+        Hold back the glyphs of a page, to be drawn at the current point. Return
+        False if they have to be drawn straight away.
+
+        """
+        cr = self._cr
+        source = cr.get_source()
+        if not isinstance(source, cairo.SolidPattern):
+            return False
+
+        # Glyphs are drawn with the translation taken out of the CTM, which
+        # just shifts them by the translation in user space
+        xx, yx, xy, yy, x0, y0 = cr.get_matrix()
+        dx, dy = cr.device_to_user_distance(x0, y0)
+
+        key = xx, yx, xy, yy, source.get_rgba()
+        batch = self.batch
+        for fn, fs, glyphs in self.textrenderer.glyph_runs(page):
+            run = batch.get(key + (fn, fs))
+            if run is None:
+                run = batch[key + (fn, fs)] = []
+            run.extend((i, gx + dx, gy + dy) for i, gx, gy in glyphs)
+        return True
+
+    def flush_text(self):
+        """Draw all the glyphs held back by batch_tex"""
+        if not self.batch:
+            return
+        cr = self._cr
+        show_glyphs = self.textrenderer.show_glyphs
+        for (xx, yx, xy, yy, rgba, fn, fs), glyphs in self.batch.iteritems():
+            cr.save()
+            cr.set_matrix(cairo.Matrix(xx, yx, xy, yy, 0, 0))
+            cr.set_source_rgba(*rgba)
+            show_glyphs(cr, fn, fs, glyphs)
+            cr.restore()
+        self.batch.clear()
 
     def draw(self, op, args):
         try:
@@ -134,41 +464,87 @@ class CairoRenderer(object):
 
 class CairoSizer(CairoRenderer):
     @depman.require(texd='texdaemon', textrenderer='textrenderer')
-    def __init__(self, texd, textrenderer):
+    def __init__(self, texd, textrenderer, pages=None):
         self.texd = texd
         self.textrenderer = textrenderer
         surf = cairo.ImageSurface(cairo.FORMAT_RGB24, 1, 1)
         self._cr = cairo.Context(surf)
         self.extents = None
+        self.pages = {} if pages is None else pages
+        self.handlers = self._handlers('size_', 'draw_')
+        # Device space boxes of the polylines, polygons and markers in the
+        # current path, which are never handed to cairo
+        self._boxes = []
 
     def size_picture(self, picture):
         self._cr.save()
-        for op, arg in ((x[0], x[1:]) for x in picture.commands):
-            self.size(op, arg)
-
+        picture.replay(self.handlers)
         self._cr.restore()
 
+    def size_command(self, command):
+        self.size(command[0], command[1:])
+
     def _update_extents(self, extents):
+        if extents == (0, 0, 0, 0):
+            # Nothing in the path
+            return
         if self.extents is None:
             self.extents = extents
         else:
             e0 = self.extents
-            ex = extents
-            if extents != (0, 0, 0, 0):
-                d2u = self._cr.user_to_device
-                ex = d2u(*ex[:2]) + d2u(*ex[2:])
-                self.extents = (min(ex[0], e0[0]), min(ex[1], e0[1]),
-                                max(ex[2], e0[2]), max(ex[3], e0[3]))
+            d2u = self._cr.user_to_device
+            ex = d2u(*extents[:2]) + d2u(*extents[2:])
+            self.extents = (min(ex[0], e0[0]), min(ex[1], e0[1]),
+                            max(ex[2], e0[2]), max(ex[3], e0[3]))
+
+
+    def _add_box(self, x0, y0, x1, y1):
+        u2d = self._cr.user_to_device
+        xs, ys = zip(u2d(x0, y0), u2d(x1, y0), u2d(x0, y1), u2d(x1, y1))
+        self._boxes.append((min(xs), min(ys), max(xs), max(ys)))
+
+    def _merge_boxes(self, dx=0, dy=0):
+        # Merge the boxes, grown by dx and dy, into the extents
+        for x0, y0, x1, y1 in self._boxes:
+            ex = x0 - dx, y0 - dy, x1 + dx, y1 + dy
+            e0 = self.extents
+            if e0 is not None:
+                ex = (min(ex[0], e0[0]), min(ex[1], e0[1]),
+                      max(ex[2], e0[2]), max(ex[3], e0[3]))
+            self.extents = ex
 
+    def size_polyline(self, xs, ys):
+        if len(xs):
+            x0, x1 = bounds(xs)
+            y0, y1 = bounds(ys)
+            self._add_box(x0, y0, x1, y1)
+
+    size_polygon = size_polyline
+
+    def size_markers(self, xs, ys, shape, size):
+        if len(xs):
+            x0, x1 = bounds(xs)
+            y0, y1 = bounds(ys)
+            self._add_box(x0 - size, y0 - size, x1 + size, y1 + size)
 
     def size_fill(self):
-        self._extents.append(self._cr.fill_extents())
+        self._update_extents(self._cr.fill_extents())
+        self._merge_boxes()
+        del self._boxes[:]
         self._cr.fill()
 
     def size_fill_preserve(self):
         self._update_extents(self._cr.fill_extents())
+        self._merge_boxes()
         self._cr.fill_preserve()
 
+    def _stroke_padding(self):
+        # Half the line width, in device space
+        w = 0.5 * self._cr.get_line_width()
+        dxx, dxy = self._cr.user_to_device_distance(w, 0)
+        dyx, dyy = self._cr.user_to_device_distance(0, w)
+        return math.hypot(dxx, dyx), math.hypot(dxy, dyy)
+
     def size_stroke(self):
         # This is necessary to get extents in device space.
         w = 0.5 * self._cr.get_line_width()
@@ -191,11 +567,18 @@ class CairoSizer(CairoRenderer):
         ex = ex[0] - dx, ex[1] - dy , ex[2] + dx , ex[3] + dy
         self._cr.restore()
         self._update_extents(ex)
+        self._merge_boxes(*self._stroke_padding())
+        del self._boxes[:]
 
         self._cr.stroke()
 
+    def size_tex(self, tex, x, y):
+        # Drawing the glyphs never touched the extents, so don't bother
+        pass
+
     def size_stroke_preserve(self):
         self._update_extents(self._cr.stroke_extents())
+        self._merge_boxes(*self._stroke_padding())
         self._cr.stroke_preserve()
 
     def size(self, op, args):
@@ -206,3 +589,233 @@ class CairoSizer(CairoRenderer):
         else:
             f(*args)
 
+
+class GeometrySizer(object):
+    """
+    Works out the device space extents of a picture from its commands alone,
+    keeping its own matrix and graphics state stack, without cairo drawing or
+    rasterising anything. The extents are conservative: strokes are padded for
+    the worst their caps and joins can do, and TeX takes up the whole box that
+    TeX gave it. Like CairoRenderer, it can't do circle or curve_to, and
+    raises ValueError for them rather than leave them out of the extents.
+
+    """
+    @depman.require(texd='texdaemon')
+    def __init__(self, texd, pages=None, miter_limit=10.0):
+        self.texd = texd
+        self.pages = {} if pages is None else pages
+        self.extents = None
+        # Cairo's defaults
+        self.matrix = 1.0, 0.0, 0.0, 1.0, 0.0, 0.0
+        self.line_width = 2.0
+        self.line_cap = 'butt'
+        self.line_join = 'miter'
+        self.miter_limit = miter_limit
+        self._stack = []
+        # The device space box of the current path, as in cairo the path isn't
+        # part of the graphics state
+        self._path = None
+        self.handlers = [getattr(self, 'size_' + name, None) or
+                         self._fallback(name) for name, _, _ in OPS]
+
+    def typeset(self, picture):
+        return typeset(self.texd, self.pages, picture)
+
+    def _fallback(self, name):
+        return lambda *args: self.size(name, args)
+
+    def size(self, op, args):
+        try:
+            f = getattr(self, 'size_%s' % op)
+        except AttributeError:
+            raise ValueError('Instruction %s is not implemented' % op)
+        return f(*args)
+
+    def size_command(self, command):
+        self.size(command[0], command[1:])
+
+    # Graphics state
+
+    def size_save(self):
+        self._stack.append((self.matrix, self.line_width, self.line_cap,
+                            self.line_join))
+
+    def size_restore(self):
+        (self.matrix, self.line_width, self.line_cap,
+         self.line_join) = self._stack.pop()
+
+    def size_picture(self, picture):
+        if isinstance(picture, FrozenPicture):
+            box = self.frozen_extents(picture)
+            if box is not None:
+                self._merge(self._device_box(*box))
+            return
+        self.size_save()
+        picture.replay(self.handlers)
+        self.size_restore()
+
+    def frozen_extents(self, picture):
+        """
+        Return the extents of a frozen picture in its own user space, worked out
+        the first time they are asked for.
+
+        """
+        try:
+            return picture.cache['extents']
+        except KeyError:
+            g = GeometrySizer(texd=self.texd, pages=self.pages,
+                              miter_limit=self.miter_limit)
+            picture.replay(g.handlers)
+            extents = picture.cache['extents'] = g.extents
+            return extents
+
+    def size_set_line_width(self, w):
+        self.line_width = w
+
+    def size_set_line_cap(self, captype):
+        self.line_cap = captype
+
+    def size_set_line_join(self, jointype):
+        self.line_join = jointype
+
+    def size_source_rgb(self, r, g, b):
+        pass
+
+    # Transformations, each applied in user space as cairo does
+
+    def size_shift(self, dx, dy):
+        xx, yx, xy, yy, x0, y0 = self.matrix
+        self.matrix = (xx, yx, xy, yy,
+                       x0 + xx * dx + xy * dy, y0 + yx * dx + yy * dy)
+
+    def size_scale(self, xscale, yscale=None):
+        yscale = yscale or xscale
+        xx, yx, xy, yy, x0, y0 = self.matrix
+        self.matrix = (xx * xscale, yx * xscale, xy * yscale, yy * yscale,
+                       x0, y0)
+
+    def size_rotate(self, angle, radians=math.radians):
+        c = math.cos(radians(angle))
+        s = math.sin(radians(angle))
+        xx, yx, xy, yy, x0, y0 = self.matrix
+        self.matrix = (xx * c + xy * s, yx * c + yy * s,
+                       xy * c - xx * s, yy * c - yx * s, x0, y0)
+
+    # Paths
+
+    def _device_box(self, x0, y0, x1, y1):
+        # The device space box around a user space box
+        xx, yx, xy, yy, tx, ty = self.matrix
+        xs = (xx * x0 + xy * y0, xx * x1 + xy * y0,
+              xx * x0 + xy * y1, xx * x1 + xy * y1)
+        ys = (yx * x0 + yy * y0, yx * x1 + yy * y0,
+              yx * x0 + yy * y1, yx * x1 + yy * y1)
+        return min(xs) + tx, min(ys) + ty, max(xs) + tx, max(ys) + ty
+
+    def _add_box(self, x0, y0, x1, y1):
+        # Add a user space box to the path
+        self._add_device(*self._device_box(x0, y0, x1, y1))
+
+    def _add_device(self, x0, y0, x1, y1):
+        p = self._path
+        if p is not None:
+            x0, y0 = min(x0, p[0]), min(y0, p[1])
+            x1, y1 = max(x1, p[2]), max(y1, p[3])
+        self._path = x0, y0, x1, y1
+
+    def size_move_to(self, x, y):
+        xx, yx, xy, yy, x0, y0 = self.matrix
+        dx = xx * x + xy * y + x0
+        dy = yx * x + yy * y + y0
+        self._add_device(dx, dy, dx, dy)
+
+    size_line_to = size_move_to
+
+    def size_rectangle(self, x, y, w, h):
+        self._add_box(x, y, x + w, y + h)
+
+    def size_polyline(self, xs, ys):
+        if not len(xs):
+            return
+        xx, yx, xy, yy, x0, y0 = self.matrix
+        if hasattr(xs, 'min') and hasattr(ys, 'min'):
+            # Exact, even when rotated
+            dxs = xx * xs + xy * ys
+            dys = yx * xs + yy * ys
+            self._add_device(float(dxs.min()) + x0, float(dys.min()) + y0,
+                             float(dxs.max()) + x0, float(dys.max()) + y0)
+        else:
+            bx0, bx1 = bounds(xs)
+            by0, by1 = bounds(ys)
+            self._add_box(bx0, by0, bx1, by1)
+
+    size_polygon = size_polyline
+
+    def size_markers(self, xs, ys, shape, size):
+        if len(xs):
+            x0, x1 = bounds(xs)
+            y0, y1 = bounds(ys)
+            self._add_box(x0 - size, y0 - size, x1 + size, y1 + size)
+
+    def size_tex(self, tex, x, y):
+        page = self.pages.get(tex)
+        if page is None:
+            page = self.pages[tex] = self.texd.page(tex)
+        status, page = page
+        (w, h), (left, bottom) = page.size, page.bl
+        self._merge(self._device_box(x + left, y + bottom - h,
+                                     x + left + w, y + bottom))
+
+    # Painting
+
+    def _merge(self, ex):
+        e0 = self.extents
+        if e0 is not None:
+            ex = (min(ex[0], e0[0]), min(ex[1], e0[1]),
+                  max(ex[2], e0[2]), max(ex[3], e0[3]))
+        self.extents = ex
+
+    def _ink(self, dx, dy):
+        # Add the path, grown by dx and dy, to the extents
+        p = self._path
+        if p is not None:
+            self._merge((p[0] - dx, p[1] - dy, p[2] + dx, p[3] + dy))
+            self._path = None
+
+    def stroke_padding(self):
+        """
+        How far a stroke can reach beyond its path, in device space. Square
+        caps reach out along the diagonal, and miters up to the miter limit.
+
+        """
+        r = 0.5 * self.line_width
+        if self.line_cap == 'square':
+            r *= math.sqrt(2)
+        xx, yx, xy, yy, _, _ = self.matrix
+        dx, dy = r * math.hypot(xx, xy), r * math.hypot(yx, yy)
+        if self.line_join == 'miter':
+            # cairo checks the miter limit after the pen has been transformed,
+            # so when it's stretched a miter can go the limit times its longest
+            # radius in any direction, not just along the pen
+            a = xx * xx + xy * xy + yx * yx + yy * yy
+            det = xx * yy - xy * yx
+            longest = math.sqrt(0.5 * (a + math.sqrt(max(a * a - 4 * det * det, 0))))
+            m = 0.5 * self.line_width * self.miter_limit * longest
+            dx, dy = max(dx, m), max(dy, m)
+        return dx, dy
+
+    def size_fill(self):
+        self._ink(0, 0)
+
+    def size_fill_preserve(self):
+        path = self._path
+        self._ink(0, 0)
+        self._path = path
+
+    def size_stroke(self):
+        self._ink(*self.stroke_padding())
+
+    def size_stroke_preserve(self):
+        path = self._path
+        self._ink(*self.stroke_padding())
+        self._path = path
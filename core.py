@@ -1,10 +1,19 @@
-from deps import depman
-from cairobackend import CairoBackend
-from tex import TexDaemon
+from deps import depman, lazy
 from picture import Picture
-from _freetype import TextRenderer
 
-depman.provide('backend', CairoBackend)
-depman.provide('texdaemon', TexDaemon)
+# Nothing heavy (cairo, FreeType, the TeX machinery) is imported until it is
+# first needed
+depman.provide('backend', lazy('cairobackend', 'CairoBackend'))
+depman.provide('texdaemon', lazy('tex', 'CachedTexDaemon'))
 depman.provide('defaultpicture', Picture)
-depman.provide('textrenderer', TextRenderer)
+depman.provide('textrenderer', lazy('_freetype', 'TextRenderer'))
+
+# To typeset with several LaTeX processes at once, provide a pool instead:
+#   depman.provide('texdaemon', lazy('tex', 'CachedTexDaemon'),
+#                  daemon=lazy('tex', 'TexDaemonPool'), size=4)
+#
+# And to draw all of a picture's text in as few show_glyphs calls as possible:
+#   depman.provide('backend', lazy('cairobackend', 'CairoBackend'),
+#                  batch_text=True)
+# Passing decimate=0.5 as well thins out polylines to what each target can show,
+# to within half a device unit.
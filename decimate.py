@@ -0,0 +1,90 @@
+# Level of detail for long data series. A polyline with far more points than
+# the output can resolve is cut down, at render time, to the points that still
+# make a difference at the resolution of the target.
+#
+# The points are mapped to device space and split into runs of consecutive
+# points that fall in the same column, `tol` device units wide. Of each run
+# only the first, last, lowest and highest points are kept, in their original
+# order. Every point dropped lies within its run's column and between its
+# lowest and highest points, both of which are drawn, so no point is ever more
+# than `tol` device units from the line that is drawn.
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def decimate(xs, ys, matrix, tol, min_points=64):
+    """
+    Return the points of the polyline through (xs, ys) that are worth drawing
+    with the given user to device matrix, as (xs, ys). Lines with fewer than
+    `min_points` points, or which would barely shrink, come back unchanged.
+
+    """
+    if len(xs) < min_points:
+        return xs, ys
+
+    if np is not None:
+        keep = _keep_numpy(np.asarray(xs, dtype=float),
+                           np.asarray(ys, dtype=float), matrix, tol)
+        if 2 * len(keep) > len(xs):
+            return xs, ys
+        return np.asarray(xs)[keep], np.asarray(ys)[keep]
+
+    keep = _keep(xs, ys, matrix, tol)
+    if 2 * len(keep) > len(xs):
+        return xs, ys
+    return [xs[i] for i in keep], [ys[i] for i in keep]
+
+
+def _keep_numpy(xs, ys, matrix, tol):
+    xx, yx, xy, yy, x0, y0 = matrix
+    col = np.floor((xx * xs + xy * ys + x0) / tol)
+    dy = yx * xs + yy * ys + y0
+    n = len(col)
+
+    starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+    ends = np.r_[starts[1:], n] - 1
+
+    # Sorted by run and then by height, each run occupies the same positions
+    # as it did before, lowest point first and highest last
+    runs = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    order = np.lexsort((dy, runs))
+
+    keep = np.concatenate((starts, ends, order[starts], order[ends]))
+    return np.unique(keep)
+
+
+def _keep(xs, ys, matrix, tol, floor=math.floor):
+    xx, yx, xy, yy, x0, y0 = matrix
+    keep = []
+
+    start = lo = hi = 0
+    col = floor((xx * xs[0] + xy * ys[0] + x0) / tol)
+    lo_y = hi_y = yx * xs[0] + yy * ys[0] + y0
+
+    for i in xrange(1, len(xs) + 1):
+        if i < len(xs):
+            x = xs[i]
+            y = ys[i]
+            c = floor((xx * x + xy * y + x0) / tol)
+            d = yx * x + yy * y + y0
+            if c == col:
+                # Ties go as they do in _keep_numpy's stable sort: to the
+                # first lowest point and the last highest
+                if d < lo_y:
+                    lo, lo_y = i, d
+                elif d >= hi_y:
+                    hi, hi_y = i, d
+                continue
+
+        keep.extend(sorted(set((start, lo, hi, i - 1))))
+        if i < len(xs):
+            start = lo = hi = i
+            col = c
+            lo_y = hi_y = d
+
+    return keep
@@ -26,6 +26,15 @@ class LazyDependencyManager(object):
         self._handlers[dep] = ref(got)
         return got
 
+    def forget(self):
+        """
+        Forget the dependencies handed out so far, so that they are made
+        afresh when next needed. For use in new processes, which shouldn't
+        share their parent's TeX daemons and the like.
+
+        """
+        self._handlers.clear()
+
     def require(self, **kx):
         that = self
         def f2(f):
@@ -36,4 +45,15 @@ class LazyDependencyManager(object):
             return f3
         return f2
 
+
+def lazy(module, name):
+    """
+    A handler which only imports `name` from `module` when it is first needed,
+    so that providing a dependency costs nothing.
+
+    """
+    def handler(*args, **kwargs):
+        return getattr(__import__(module), name)(*args, **kwargs)
+    return handler
+
 depman = LazyDependencyManager()
@@ -0,0 +1,163 @@
+# A small persistent cache. Every entry lives in its own file, named after the
+# hash of its key, so writes can be made atomic (write a temporary file, then
+# rename it into place) and several processes can share one store without any
+# locking. Recency is tracked through the file mtimes, which doubles as the LRU
+# bookkeeping for eviction.
+
+import os
+import hashlib
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def cache_root():
+    """Return the directory under which all of the on-disk caches live"""
+    root = os.environ.get('PLOTYPY_CACHE')
+    if root:
+        return root
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'plotypy')
+
+
+def _dumps(value, dumps=pickle.dumps):
+    return dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class DiskCache(object):
+    """
+    A versioned, size-bounded key/value store on disk. Once the store grows
+    beyond `max_size` bytes, the least recently used entries are evicted.
+
+    """
+    def __init__(self, name, version, max_size=64 << 20, root=None,
+                 dumps=_dumps, loads=pickle.loads):
+        self.name = name
+        self.version = version
+        self.max_size = max_size
+        self._root = root
+        self._dumps = dumps
+        self._loads = loads
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        # Resolved late so that the environment can be changed after import
+        return os.path.join(self._root or cache_root(),
+                            '%s-v%d' % (self.name, self.version))
+
+    def filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key, default=None):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            return default
+
+        try:
+            value = self._loads(data)
+        except Exception:
+            # A truncated or otherwise corrupt entry is just a miss
+            self._remove(filename)
+            self.misses += 1
+            return default
+
+        # Mark as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        data = self._dumps(value)
+        path = self.path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+        # An entry being replaced no longer counts towards the size
+        filename = self.filename(key)
+        try:
+            replaced = os.stat(filename).st_size
+        except OSError:
+            replaced = 0
+
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, filename)
+        except:
+            self._remove(tmp)
+            raise
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data) - replaced
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        path = self.path
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+
+        for name in names:
+            if name.startswith('.'):
+                continue
+            filename = os.path.join(path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            yield st.st_mtime, st.st_size, filename
+
+    def evict(self, target=None):
+        """
+        Remove the least recently used entries until the store is below
+        `target` bytes (by default three quarters of the maximum size).
+
+        """
+        if target is None:
+            target = (self.max_size * 3) // 4
+
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= target:
+                break
+            self._remove(filename)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(0)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -1,5 +1,8 @@
 # This module doesn't even need cairo, but it's important that it does
 
+from itertools import izip
+from array import array
+
 from deps import depman
 
 default_units = {
@@ -11,22 +14,153 @@ default_units = {
 }
 
 
+# Commands are stored compactly: an opcode per command, then its numeric
+# arguments in one flat array of doubles, and anything else (subpictures, TeX,
+# cap and join names) in a list on the side. Each opcode is listed with the
+# number of objects and then of numbers it takes, objects coming first.
+# Commands not listed here, or which don't fit, are kept whole as a 'command'.
+# The opcodes are saved in picture files (see picturefile.py), so new ones only
+# ever go on the end.
+OPS = [
+    ('command', 1, 0),
+    ('picture', 1, 0),
+    ('move_to', 0, 2),
+    ('line_to', 0, 2),
+    ('curve_to', 0, 2),
+    ('rectangle', 0, 4),
+    ('circle', 0, 5),
+    ('stroke', 0, 0),
+    ('fill', 0, 0),
+    ('source_rgb', 0, 3),
+    ('set_line_width', 0, 1),
+    ('set_line_cap', 1, 0),
+    ('set_line_join', 1, 0),
+    ('rotate', 0, 1),
+    ('scale', 0, 2),
+    ('shift', 0, 2),
+    ('tex', 1, 2),
+    ('polyline', 2, 0),
+    ('polygon', 2, 0),
+    ('markers', 3, 1),
+]
+
+MARKERS = ('circle', 'square', 'diamond', 'triangle')
+
+OPCODES = dict((name, i) for i, (name, _, _) in enumerate(OPS))
+COMMAND = OPCODES['command']
+PICTURE = OPCODES['picture']
+_arity = [(nobjs, nargs) for _, nobjs, nargs in OPS]
+
+
+def _check_points(xs, ys):
+    if len(xs) != len(ys):
+        raise ValueError('%d x coordinates but %d y coordinates' %
+                         (len(xs), len(ys)))
+
+
 class Picture(object):
     """A drawing is a sequence of commands."""
-    __slots__ = ['commands', 'backend', '_units', '_default_units']
+    __slots__ = ['_ops', '_args', '_objs', '_objops',
+                 'backend', '_units', '_default_units']
 
     @depman.require(backend='backend')
     def __init__(self, backend, commands=(),
                  units=default_units):
         self.backend = backend
-        self.commands = list(commands)
+        self._ops = array('B')
+        self._args = array('d')
+        self._objs = []
+        # The opcode each of _objs belongs to
+        self._objops = array('B')
+        self.extend(commands)
         self._default_units = units.get('default', 'pt')
         self._units = default_units
 
-    def _cput(self, *args):
-        self.commands.append(args)
+    def _cput(self, name, *args):
+        op = OPCODES.get(name, COMMAND)
+        nobjs, nargs = _arity[op]
+
+        if len(args) != nobjs + nargs:
+            op = COMMAND
+        elif op != COMMAND:
+            n = len(self._args)
+            try:
+                self._args.extend(args[nobjs:])
+            except TypeError:
+                del self._args[n:]
+                op = COMMAND
+
+        if op == COMMAND:
+            objs = (name,) + args,
+        else:
+            objs = args[:nobjs]
+
+        self._ops.append(op)
+        self._objs.extend(objs)
+        self._objops.extend([op] * len(objs))
         return self
 
+    @property
+    def commands(self):
+        """
+        The commands, as a tuple of (name, args...) tuples. They are put
+        together afresh each time, so add to the picture with append or extend.
+
+        """
+        commands = []
+        args = self._args
+        objs = self._objs
+        i = j = 0
+        for op in self._ops:
+            nobjs, nargs = _arity[op]
+            if op == COMMAND:
+                commands.append(objs[j])
+            else:
+                commands.append((OPS[op][0],) + tuple(objs[j:j + nobjs]) +
+                                tuple(args[i:i + nargs]))
+            i += nargs
+            j += nobjs
+        return tuple(commands)
+
+    def append(self, command):
+        """Add `command`, a (name, args...) tuple, to the end of the picture"""
+        return self._cput(*command)
+
+    def extend(self, commands):
+        """Add each of `commands` to the end of the picture"""
+        for command in commands:
+            self._cput(*command)
+        return self
+
+    def objects(self):
+        """Return (opcode, object) for every object held by the commands"""
+        return izip(self._objops, self._objs)
+
+    def replay(self, handlers, arity=_arity):
+        """
+        Call handlers[opcode] with the arguments of each command in turn.
+        Commands kept whole are passed as a single tuple.
+
+        """
+        args = self._args
+        objs = self._objs
+        i = j = 0
+        for op in self._ops:
+            f = handlers[op]
+            nobjs, nargs = arity[op]
+            if nobjs:
+                f(*(objs[j:j + nobjs] + args[i:i + nargs].tolist()))
+                j += nobjs
+            elif nargs == 2:
+                f(args[i], args[i + 1])
+            elif nargs == 0:
+                f()
+            elif nargs == 1:
+                f(args[i])
+            else:
+                f(*args[i:i + nargs])
+            i += nargs
+
     def subpicture(self, commands=()):
         """
         Create a picture which is added to this picture. Return new
@@ -70,6 +204,33 @@ class Picture(object):
         """
         return self._cput('rectangle', x, y, w, h)
 
+    def polyline(self, xs, ys):
+        """
+        Add a line through the points (xs[i], ys[i]) to the path. xs and ys
+        are kept as they are, not copied, so NumPy arrays cost nothing to add
+        but must not be changed afterwards.
+
+        """
+        _check_points(xs, ys)
+        return self._cput('polyline', xs, ys)
+
+    def polygon(self, xs, ys):
+        """Like polyline, but closes the line back to its start."""
+        _check_points(xs, ys)
+        return self._cput('polygon', xs, ys)
+
+    def markers(self, xs, ys, shape='circle', size=2.0):
+        """
+        Add a marker to the path at each of the points (xs[i], ys[i]), as for
+        polyline. `size` is the distance from the centre of a marker to its
+        edge; `shape` is one of MARKERS.
+
+        """
+        if shape not in MARKERS:
+            raise ValueError('Unknown marker shape %r' % (shape,))
+        _check_points(xs, ys)
+        return self._cput('markers', xs, ys, shape, size)
+
     def linecap(self, captype):
         return self._cput('set_line_cap', captype)
 
@@ -124,6 +285,14 @@ class Picture(object):
         """
         return self.backend.save(self, filename, filetype)
 
+    def save_many(self, targets):
+        """
+        Save the picture to several files at once, see
+        `CairoBackend.save_many`.
+
+        """
+        return self.backend.save_many(self, targets)
+
     def show(self, block=False):
         """
         Show the picture.
@@ -150,6 +319,73 @@ class Picture(object):
         return (s * x, s * y)
 
 
+    def freeze(self, memo=None):
+        """
+        Return an immutable copy of the picture, with its subpictures frozen
+        too. Backends may draw a frozen picture from a recording made once,
+        and so it is always drawn as if on its own: it doesn't pick up the line
+        width, colour and so on from where it is used, and any path it leaves
+        unfinished is dropped.
+
+        """
+        memo = {} if memo is None else memo
+        frozen = memo.get(id(self))
+        if frozen is None:
+            frozen = memo[id(self)] = FrozenPicture(self, memo)
+        return frozen
+
+    def __getstate__(self):
+        # The backend is left behind, to be found again wherever the picture
+        # is unpickled; the arrays go as plain bytes
+        units = None if self._units is default_units else self._units
+        return (self._ops.tostring(), self._args.tostring(), self._objs,
+                self._objops.tostring(), units, self._default_units)
+
+    def __setstate__(self, state):
+        ops, args, objs, objops, units, self._default_units = state
+        self.backend = depman.get('backend')
+        self._ops = array('B')
+        self._ops.fromstring(ops)
+        self._args = array('d')
+        self._args.fromstring(args)
+        self._objs = objs
+        self._objops = array('B')
+        self._objops.fromstring(objops)
+        self._units = default_units if units is None else units
+
     def __repr__(self):
         return '<Picture(%r)>' % self.commands
 
+
+class FrozenPicture(Picture):
+    """
+    A picture that can no longer be changed; see Picture.freeze. `cache` is
+    for backends to keep whatever they can reuse between uses of it.
+
+    """
+    __slots__ = ['cache']
+
+    def __init__(self, picture, memo):
+        self.backend = picture.backend
+        self._ops = array('B', picture._ops)
+        self._args = array('d', picture._args)
+        self._objops = array('B', picture._objops)
+        self._objs = [obj.freeze(memo) if op == PICTURE else obj
+                      for op, obj in izip(picture._objops, picture._objs)]
+        self._default_units = picture._default_units
+        self._units = picture._units
+        self.cache = {}
+
+    def _cput(self, *args):
+        raise RuntimeError('Frozen pictures cannot be changed')
+
+    def freeze(self, memo=None):
+        return self
+
+    def __setstate__(self, state):
+        Picture.__setstate__(self, state)
+        self.cache = {}
+
+    def __repr__(self):
+        return '<FrozenPicture(%r)>' % self.commands
+
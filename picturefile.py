@@ -0,0 +1,342 @@
+# A binary file format for pictures, so that they can be made in one place and
+# drawn in another. It is laid out much like Picture itself: for each picture,
+# its opcodes, the opcodes of its objects and its arguments as raw arrays, and
+# then the objects. Bulk numbers (polyline coordinates and the like) are stored
+# as raw doubles on 8 byte boundaries, so that a file mapped into memory can be
+# drawn straight from the mapping.
+#
+# A file is a 16 byte header,
+#
+#     magic 'PLPY', version (u8), byte order ('<' or '>'), 2 bytes padding,
+#     number of pictures (u32), 4 bytes padding
+#
+# and then every picture, subpictures before the pictures that use them, the
+# last being the picture itself. Each picture is
+#
+#     flags (u8, 1 if frozen), 3 bytes padding, number of commands,
+#     arguments and objects and the length of the default units (u32 each),
+#     the default units, the opcodes (u8 each), the objects' opcodes (u8 each),
+#     padding to 8 bytes, the arguments (doubles), and then the objects
+#
+# and each object a tag byte followed by its value:
+#
+#     'N' None, 'T' True, 'F' False, 'i' integer (i64), 'd' double,
+#     's' string and 'u' unicode (u32 length, then UTF-8), 't' tuple and
+#     'l' list (u32 length, then the items), 'a' array of doubles (u32
+#     length, padding to 8 bytes, then the doubles), 'r' the same array as
+#     an earlier one (u32 index, counting every 'a' so far), 'p' picture
+#     (u32 index)
+#
+# The opcodes are those of picture.OPS, which is why that list only ever grows
+# at the end. Anything else that changes the layout must bump VERSION.
+
+import sys
+import mmap
+import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from picture import OPS, OPCODES, _arity, Picture, FrozenPicture
+
+MAGIC = 'PLPY'
+VERSION = 1
+NATIVE = '<' if sys.byteorder == 'little' else '>'
+
+HEADER = struct.Struct(NATIVE + '4sBcxxIxxxx')
+RECORD = struct.Struct(NATIVE + 'BxxxIIII')
+U32 = struct.Struct(NATIVE + 'I')
+I64 = struct.Struct(NATIVE + 'q')
+F64 = struct.Struct(NATIVE + 'd')
+
+FROZEN = 1
+
+# The coordinates of these are always stored as arrays
+_ARRAYS = frozenset(OPCODES[name] for name in ('polyline', 'polygon', 'markers'))
+
+
+class _Writer(object):
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+        # id(picture) -> index, or None while the picture is being written
+        self.index = {}
+        self.count = 0
+        # id(array) -> index, for arrays shared between commands (such as
+        # the x coordinates of several series)
+        self.arrays = {}
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def align(self):
+        pad = -self.offset % 8
+        if pad:
+            self.write('\0' * pad)
+
+    def doubles(self, values):
+        i = self.arrays.get(id(values))
+        if i is not None:
+            self.write('r' + U32.pack(i))
+            return
+        self.arrays[id(values)] = len(self.arrays)
+
+        self.write('a')
+        if np is not None:
+            data = np.ascontiguousarray(values, dtype=float).tostring()
+        else:
+            data = array('d', values).tostring()
+        self.write(U32.pack(len(data) // 8))
+        self.align()
+        self.write(data)
+
+    def picture(self, pic):
+        key = id(pic)
+        if key in self.index:
+            i = self.index[key]
+            if i is None:
+                raise ValueError('Pictures cannot contain themselves')
+            return i
+        self.index[key] = None
+
+        # Subpictures go first, so that they're loaded by the time they're used
+        for _, obj in pic.objects():
+            self.subpictures(obj)
+
+        units = pic._default_units.encode('utf-8')
+        flags = FROZEN if isinstance(pic, FrozenPicture) else 0
+        self.write(RECORD.pack(flags, len(pic._ops), len(pic._args),
+                               len(pic._objs), len(units)))
+        self.write(units)
+        self.write(pic._ops.tostring())
+        self.write(pic._objops.tostring())
+        self.align()
+        self.write(pic._args.tostring())
+
+        # The first two objects of each array op are its coordinates. Each
+        # command has the same number of objects, so a run of them of one op
+        # can be split up by counting.
+        last = None
+        k = 0
+        for op, obj in pic.objects():
+            k = k + 1 if op == last else 0
+            last = op
+            if op in _ARRAYS and k % _arity[op][0] < 2:
+                self.doubles(obj)
+            else:
+                self.value(obj)
+
+        i = self.index[key] = self.count
+        self.count += 1
+        return i
+
+    def subpictures(self, v):
+        if isinstance(v, Picture):
+            self.picture(v)
+        elif isinstance(v, (tuple, list)):
+            for item in v:
+                self.subpictures(item)
+
+    def value(self, v):
+        write = self.write
+        if v is None:
+            write('N')
+        elif v is True:
+            write('T')
+        elif v is False:
+            write('F')
+        elif isinstance(v, (int, long)):
+            try:
+                write('i' + I64.pack(v))
+            except struct.error:
+                raise ValueError('Integer %r is too large to be saved' % v)
+        elif isinstance(v, float):
+            write('d' + F64.pack(v))
+        elif isinstance(v, str):
+            write('s' + U32.pack(len(v)) + v)
+        elif isinstance(v, unicode):
+            v = v.encode('utf-8')
+            write('u' + U32.pack(len(v)) + v)
+        elif isinstance(v, (tuple, list)):
+            write(('t' if isinstance(v, tuple) else 'l') + U32.pack(len(v)))
+            for item in v:
+                self.value(item)
+        elif isinstance(v, Picture):
+            write('p' + U32.pack(self.picture(v)))
+        elif isinstance(v, array) or (np is not None and
+                                      isinstance(v, np.ndarray)):
+            self.doubles(v)
+        else:
+            raise ValueError('Cannot save %r in a picture file' % (v,))
+
+
+def dumps(pic):
+    """Return `pic`, and everything in it, in the picture file format"""
+    w = _Writer()
+    w.write('\0' * HEADER.size)
+    w.picture(pic)
+    w.chunks[0] = HEADER.pack(MAGIC, VERSION, NATIVE, w.count)
+    return ''.join(w.chunks)
+
+
+def dump(pic, filename):
+    with open(filename, 'wb') as f:
+        f.write(dumps(pic))
+
+
+class _Reader(object):
+    def __init__(self, data, order):
+        self.data = data
+        self.swap = order != NATIVE
+        self.u32 = struct.Struct(order + 'I').unpack_from
+        self.i64 = struct.Struct(order + 'q').unpack_from
+        self.f64 = struct.Struct(order + 'd').unpack_from
+        self.record = struct.Struct(order + 'BxxxIIII').unpack_from
+        self.dtype = order + 'f8'
+        self.pictures = []
+        self.arrays = []
+
+    def doubles(self, offset):
+        n, = self.u32(self.data, offset)
+        offset += 4
+        offset += -offset % 8
+        end = offset + 8 * n
+        if end > len(self.data):
+            raise ValueError('Picture file is truncated')
+        if np is not None:
+            # A view of the data, which stays mapped for as long as it's used
+            a = np.frombuffer(self.data, self.dtype, n, offset)
+        else:
+            a = array('d')
+            a.fromstring(self.data[offset:end])
+            if self.swap:
+                a.byteswap()
+        self.arrays.append(a)
+        return a, end
+
+    def picture(self, offset):
+        flags, nops, nargs, nobjs, nunits = self.record(self.data, offset)
+        offset += RECORD.size
+        data = self.data
+        units = data[offset:offset + nunits].decode('utf-8')
+        offset += nunits
+        ops = data[offset:offset + nops]
+        offset += nops
+        objops = data[offset:offset + nobjs]
+        offset += nobjs
+        offset += -offset % 8
+        args = data[offset:offset + 8 * nargs]
+        offset += 8 * nargs
+        if offset > len(data):
+            raise ValueError('Picture file is truncated')
+
+        objs = []
+        for _ in xrange(nobjs):
+            obj, offset = self.value(offset)
+            objs.append(obj)
+
+        cls = FrozenPicture if flags & FROZEN else Picture
+        pic = cls.__new__(cls)
+        pic.__setstate__((ops, args, objs, objops, None, units))
+        if self.swap:
+            pic._args.byteswap()
+        self.check(pic)
+        self.pictures.append(pic)
+        return offset
+
+    def check(self, pic):
+        ops = pic._ops
+        if ops and max(ops) >= len(OPS):
+            raise ValueError('Unknown opcode %d in picture file' % max(ops))
+        nobjs = nargs = 0
+        for op, (n, m) in enumerate(_arity):
+            k = ops.count(op)
+            nobjs += k * n
+            nargs += k * m
+        if nobjs != len(pic._objs) or nargs != len(pic._args):
+            raise ValueError('Picture file is corrupt')
+
+    def value(self, offset):
+        data = self.data
+        tag = data[offset:offset + 1]
+        offset += 1
+        if tag == 'N':
+            return None, offset
+        elif tag == 'T':
+            return True, offset
+        elif tag == 'F':
+            return False, offset
+        elif tag == 'i':
+            return self.i64(data, offset)[0], offset + 8
+        elif tag == 'd':
+            return self.f64(data, offset)[0], offset + 8
+        elif tag == 's' or tag == 'u':
+            n, = self.u32(data, offset)
+            offset += 4
+            v = data[offset:offset + n]
+            return (v.decode('utf-8') if tag == 'u' else v), offset + n
+        elif tag == 't' or tag == 'l':
+            n, = self.u32(data, offset)
+            offset += 4
+            items = []
+            for _ in xrange(n):
+                item, offset = self.value(offset)
+                items.append(item)
+            return (tuple(items) if tag == 't' else items), offset
+        elif tag == 'a':
+            return self.doubles(offset)
+        elif tag == 'r':
+            i, = self.u32(data, offset)
+            if i >= len(self.arrays):
+                raise ValueError('Picture file is corrupt')
+            return self.arrays[i], offset + 4
+        elif tag == 'p':
+            i, = self.u32(data, offset)
+            if i >= len(self.pictures):
+                raise ValueError('Picture file is corrupt')
+            return self.pictures[i], offset + 4
+        raise ValueError('Unknown tag %r in picture file' % tag)
+
+
+def loads(data):
+    """
+    Return the picture saved in `data`, a string or anything else supporting
+    the buffer interface (such as an mmap). Arrays of coordinates may be views
+    of `data`, rather than copies, so it mustn't change while the picture is
+    in use.
+
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Not a picture file')
+    magic, version, order = struct.unpack_from('4sBc', data)
+    if magic != MAGIC or order not in '<>':
+        raise ValueError('Not a picture file')
+    if version != VERSION:
+        raise ValueError('Unsupported picture file version %d' % version)
+
+    r = _Reader(data, order)
+    n, = r.u32(data, 8)
+    offset = HEADER.size
+    try:
+        for _ in xrange(n):
+            offset = r.picture(offset)
+    except struct.error:
+        raise ValueError('Picture file is truncated')
+    if not r.pictures:
+        raise ValueError('Picture file is empty')
+    return r.pictures[-1]
+
+
+def load(filename):
+    """
+    Load the picture saved in `filename`, mapping the file into memory so
+    that its coordinates are only read when the picture is drawn.
+
+    """
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(data)
@@ -0,0 +1,132 @@
+# Checks that the NumPy TFM reading gives exactly what the plain loops do.
+#
+#     python -m unittest test_tfm
+
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+import tex
+
+
+def fix_words(values):
+    return b''.join(struct.pack('>i', v) for v in values)
+
+
+def make_tfm(bc, chars, widths, heights, depths):
+    """
+    A TFM file with just the parts read_tfm looks at. `chars` holds the
+    width, height and depth index of each character from `bc` on.
+
+    """
+    char_info = bytearray()
+    for w, h, d in chars:
+        char_info.extend((w, h << 4 | d, 0, 0))
+    lh = 2
+    lf = 6 + lh + len(chars) + len(widths) + len(heights) + len(depths)
+    return (struct.pack('>12H', lf, lh, bc, bc + len(chars) - 1, len(widths),
+                        len(heights), len(depths), 0, 0, 0, 0, 0) +
+            struct.pack('>II', 0, 10 << 20) + bytes(char_info) +
+            fix_words(widths) + fix_words(heights) + fix_words(depths))
+
+
+# Scales either side of where tfm_widths starts halving them, and the largest
+# a DVI file can have
+SCALES = [1, 10 << 16, 0o37777777, 0o40000000, 0o100000001, (1 << 27) - 1]
+
+
+class TfmWidthsTest(unittest.TestCase):
+    def widths(self, data, n, z):
+        return list(tex.tfm_widths(iter(bytearray(data)), n, z))
+
+    def test_zero_and_negative(self):
+        z = 10 << 16
+        data = fix_words([0, 1 << 20, -(1 << 20), -1])
+        widths = self.widths(data, 4, z)
+        # The smallest negative width still rounds down, as TeX does
+        self.assertEqual(widths, [0, z, -z, -1])
+
+    def test_invalid(self):
+        data = b'\x01\0\0\0'
+        self.assertRaises(RuntimeError, self.widths, data, 1, 10 << 16)
+        if tex.np is not None:
+            self.assertRaises(RuntimeError, tex.tfm_widths_array,
+                              data, 0, 1, 10 << 16)
+
+    @unittest.skipIf(tex.np is None, 'needs NumPy')
+    def test_array_matches_loop(self):
+        rng = random.Random(0)
+        values = [0, 1, -1, (1 << 24) - 1, -(1 << 24)]
+        values += [rng.randrange(-(1 << 24), 1 << 24) for _ in xrange(500)]
+        data = b'\0' * 8 + fix_words(values)
+        scales = SCALES + [rng.randrange(1, 1 << 27) for _ in xrange(50)]
+        for z in scales:
+            got = tex.tfm_widths_array(data, 8, len(values), z)
+            self.assertEqual(list(got), self.widths(data[8:], len(values), z),
+                             'scale %d' % z)
+
+
+class ReadTfmTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rng = random.Random(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def table(self, n):
+        # The first entry of each table is always zero
+        return [0] + [self.rng.randrange(-(1 << 24), 1 << 24)
+                      for _ in xrange(n - 1)]
+
+    def scaled(self, values, z):
+        return list(tex.tfm_widths(iter(bytearray(fix_words(values))),
+                                   len(values), z))
+
+    def test_ranges(self):
+        for bc, ec in [(0, 0), (255, 255), (0, 255), (65, 90)]:
+            widths, heights, depths = (self.table(40), self.table(16),
+                                       self.table(16))
+            chars = [(self.rng.randrange(40), self.rng.randrange(16),
+                      self.rng.randrange(16)) for _ in xrange(1 + ec - bc)]
+            filename = os.path.join(self.dir, 'test.tfm')
+            with open(filename, 'wb') as f:
+                f.write(make_tfm(bc, chars, widths, heights, depths))
+
+            for z in SCALES:
+                ws, hs, ds = [self.scaled(t, z)
+                              for t in (widths, heights, depths)]
+                expected = ([ws[w] for w, _, _ in chars],
+                            [hs[h] for _, h, _ in chars],
+                            [ds[d] for _, _, d in chars])
+                for vectorize in (False, True):
+                    if vectorize and tex.np is None:
+                        continue
+                    size, first, ws2, hs2, ds2 = tex.read_tfm(
+                        filename, z, 10 << 16, vectorize=vectorize)
+                    self.assertEqual(first, bc)
+                    how = 'NumPy' if vectorize else 'loops'
+                    self.assertEqual((list(ws2), list(hs2), list(ds2)),
+                                     expected, 'characters %d-%d, scale %d, %s'
+                                     % (bc, ec, z, how))
+
+    def test_without_numpy(self):
+        chars = [(i % 40, i % 16, 15 - i % 16) for i in xrange(96)]
+        filename = os.path.join(self.dir, 'test.tfm')
+        with open(filename, 'wb') as f:
+            f.write(make_tfm(32, chars, self.table(40), self.table(16),
+                             self.table(16)))
+        expected = tex.read_tfm(filename, 10 << 16, 10 << 16, vectorize=False)
+        np, tex.np = tex.np, None
+        try:
+            self.assertEqual(tex.read_tfm(filename, 10 << 16, 10 << 16),
+                             expected)
+        finally:
+            tex.np = np
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,16 +8,29 @@
 # not export a 'default' TexDaemon.
 
 import os
+import sys
 import time
 import threading
+import multiprocessing
 import subprocess as sp
 import operator
 import itertools
+import collections
 import re
 from functools import partial
 from contextlib import contextmanager
 import tempfile
 import shutil
+import struct
+import marshal
+from array import array
+
+from diskcache import DiskCache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 try:
     import Queue as queue
@@ -153,67 +166,370 @@ unsigned = None, I1, I2, I3, I4
 signed = None, i1, i2, i3, i4
 
 
+###############################################################
+# The same again, reading from a buffer at an explicit offset #
+###############################################################
+
+class Underflow(Exception):
+    """Raised when a buffer reader runs off the end of the data it has"""
+
+
+class ByteBuffer(object):
+    """
+    A contiguous buffer of bytes with a read offset. When the data runs out, it
+    can be topped up from `source`, an iterator of strings.
+
+    """
+    __slots__ = ('data', 'pos', 'source')
+    def __init__(self, data='', source=()):
+        self.data = bytearray(data)
+        self.pos = 0
+        self.source = iter(source)
+
+    def fill(self):
+        """Append the next chunk from the source, dropping consumed bytes"""
+        chunk = next(self.source)
+        del self.data[:self.pos]
+        self.pos = 0
+        self.data.extend(chunk)
+
+
+def _buf_reader(name, fmt, combine=None):
+    unpack_from = struct.Struct(fmt).unpack_from
+    size = struct.calcsize(fmt)
+    error = struct.error
+
+    if combine is None:
+        def reader(buf):
+            pos = buf.pos
+            try:
+                value, = unpack_from(buf.data, pos)
+            except error:
+                raise Underflow
+            buf.pos = pos + size
+            return value
+    else:
+        # Three byte integers have no struct format of their own
+        def reader(buf):
+            pos = buf.pos
+            try:
+                hi, lo = unpack_from(buf.data, pos)
+            except error:
+                raise Underflow
+            buf.pos = pos + size
+            return (hi << 16) | lo
+
+    reader.__name__ = name
+    return reader
+
+
+buf_I1 = _buf_reader('buf_I1', '>B')
+buf_I2 = _buf_reader('buf_I2', '>H')
+buf_I3 = _buf_reader('buf_I3', '>BH', combine=True)
+buf_I4 = _buf_reader('buf_I4', '>I')
+buf_i1 = _buf_reader('buf_i1', '>b')
+buf_i2 = _buf_reader('buf_i2', '>h')
+buf_i3 = _buf_reader('buf_i3', '>bH', combine=True)
+buf_i4 = _buf_reader('buf_i4', '>i')
+
+buf_unsigned = None, buf_I1, buf_I2, buf_I3, buf_I4
+buf_signed = None, buf_i1, buf_i2, buf_i3, buf_i4
+
+
+def buf_read_string(buf, n):
+    """Read the given number of chars from the buffer"""
+    pos = buf.pos
+    end = pos + n
+    data = buf.data
+    if end > len(data):
+        raise Underflow
+    buf.pos = end
+    return str(data[pos:end])
+
+
 # Kpsewhich is the standard unixy way of finding TeX files. Unfortunately, the
 # TeX distros on a certain outdated run target (SLC5) does not come with the
 # kpsewhich library. So we have to make do with the program
+def kpsewhich_many(fnames):
+    """
+    Run kpsewhich once for all of the given names. Return a dict from each name
+    to its path, or '' if it wasn't found.
+
+    """
+    fnames = list(fnames)
+    query = ['kpsewhich'] + fnames
+    out = sp.Popen(query, stdout=sp.PIPE).communicate()[0]
+
+    # kpsewhich prints nothing for names it cannot find, so match the paths
+    # back up by their basenames
+    found = {}
+    for path in out.splitlines():
+        path = path.strip()
+        if path:
+            found.setdefault(os.path.basename(path), path)
+    return dict((f, found.get(os.path.basename(f), '')) for f in fnames)
+
+
+def read_lsr(filename, subtrees):
+    """
+    Read a kpathsea ls-R database. Return a dict from file name to path, for
+    the files which lie under the subtree `subtrees` gives for their suffix,
+    e.g. {'.tfm': 'fonts/tfm'}, much as kpsewhich only searches each format's
+    own path.
+
+    """
+    root = os.path.dirname(filename)
+    directory = root
+    # The suffixes wanted from the current directory
+    suffixes = ()
+    index = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('%'):
+                continue
+            if line.endswith(':'):
+                rel = os.path.normpath(line[:-1])
+                directory = os.path.join(root, rel)
+                suffixes = tuple(suffix for suffix, sub in subtrees.iteritems()
+                                 if rel == sub or rel.startswith(sub + '/'))
+            elif suffixes and line.endswith(suffixes):
+                index.setdefault(line, os.path.join(directory, line))
+    return index
+
+
+def user_trees(variables=('TEXMFHOME', 'TEXMFVAR')):
+    """Return the user's own TEXMF trees, which usually have no ls-R"""
+    trees = []
+    for var in variables:
+        out = sp.Popen(['kpsewhich', '-var-value=%s' % var],
+                       stdout=sp.PIPE).communicate()[0]
+        for tree in out.strip().split(os.pathsep):
+            tree = tree.strip().lstrip('!')
+            if tree:
+                trees.append(os.path.normpath(os.path.expanduser(tree)))
+    return trees
+
+
+# Bump whenever the layout of the cached index changes
+INDEX_CACHE_VERSION = 2
+
+
+class KpseResolver(object):
+    """
+    Finds TeX files. Every lookup is memoised, many names can be resolved with a
+    single run of kpsewhich, and an index built from the ls-R databases of the
+    TEXMF trees answers most lookups without running kpsewhich at all. The
+    index is persisted, and rebuilt whenever one of the databases changes.
+
+    Only the font subtrees are indexed, where kpsewhich would look for each
+    kind of file. Files in a user's own tree without an ls-R (as made by
+    updmap-user, say) must win over the system's, so while there is one of
+    those, every lookup goes to kpsewhich.
+
+    """
+    subtrees = {
+        '.tfm': 'fonts/tfm',
+        '.vf': 'fonts/vf',
+        '.pfb': 'fonts/type1',
+        '.pfa': 'fonts/type1',
+        '.enc': 'fonts/enc',
+        '.map': 'fonts/map',
+    }
+
+    def __init__(self, use_index=True):
+        self.use_index = use_index
+        self.cache = DiskCache('kpathsea', INDEX_CACHE_VERSION,
+                               max_size=32 << 20,
+                               dumps=marshal.dumps, loads=marshal.loads)
+        self._found = {}
+        self._index = None
+        self._lock = threading.Lock()
+
+    def find(self, fname):
+        path = self._found.get(fname)
+        if path is None:
+            path = self.find_many([fname])[fname]
+        return path
+
+    def find_many(self, fnames):
+        fnames = list(fnames)
+        found = self._found
+        missing = [f for f in set(fnames) if f not in found]
+
+        if missing:
+            index = self.index()
+            rest = []
+            for f in missing:
+                path = index.get(f)
+                if path and os.path.exists(path):
+                    found[f] = path
+                else:
+                    rest.append(f)
+            if rest:
+                found.update(kpsewhich_many(rest))
+
+        return dict((f, found[f]) for f in fnames)
+
+    def index(self):
+        """Return the index of the TEXMF trees, loading it if necessary"""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load_index() if self.use_index else {}
+        return self._index
+
+    def _load_index(self):
+        cached = self.cache.get('index')
+        if cached is not None:
+            databases, trees, index = cached
+            if all(_mtime(f) == mtime for f, mtime in databases):
+                return self._usable(databases, trees, index)
+        return self.build_index()
+
+    @staticmethod
+    def _usable(databases, trees, index):
+        # Checked on every load, since a user tree may turn up at any time
+        indexed = set(os.path.dirname(os.path.normpath(f))
+                      for f, _ in databases)
+        for tree in trees:
+            if tree not in indexed and os.path.isdir(tree):
+                return {}
+        return index
+
+    def build_index(self):
+        """Build the index from the ls-R databases afresh, and persist it"""
+        out = sp.Popen(['kpsewhich', '-all', 'ls-R'],
+                       stdout=sp.PIPE).communicate()[0]
+        filenames = [f.strip() for f in out.splitlines() if f.strip()]
+
+        # Earlier trees take precedence, just as they do for kpsewhich
+        index = {}
+        for filename in reversed(filenames):
+            try:
+                index.update(read_lsr(filename, self.subtrees))
+            except IOError:
+                pass
+
+        databases = [(f, _mtime(f)) for f in filenames]
+        trees = user_trees()
+        self.cache.put('index', (databases, trees, index))
+        self._index = self._usable(databases, trees, index)
+        return self._index
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+resolver = KpseResolver()
+
+
 def kpsewhich(fname):
-    """Run kpsewhich with the necessary arguments"""
-    query = 'kpsewhich', fname
-    return sp.Popen(query, stdout=sp.PIPE).communicate()[0].strip()
+    """Find a TeX file, as kpsewhich would"""
+    return resolver.find(fname)
+
+
+# Bump whenever the layout of the cached fontmap changes
+FONTMAP_CACHE_VERSION = 1
+
+
+def tokenize_map_line(line):
+    """
+    Split a line of a fontmap into the PostScript names, font files, encodings
+    and PostScript options it gives.
+
+    """
+    in_quote = False
+    names = []
+    psopts = []
+    pfbs = []
+    encodings = []
+
+    for token in line.split():
+        if in_quote:
+            if token == '"':
+                in_quote = False
+            else:
+                psopts.append(token)
+        else:
+            if token == '"':
+                in_quote = True
+            elif token.startswith('<<'):
+                pfbs.append(token[2:])
+            elif token.startswith('<['):
+                encodings.append(token[2:])
+            elif token.startswith('<'):
+                r = token[1:]
+                if r.endswith('.enc'):
+                    encodings.append(r)
+                elif r.endswith('.pfb') or r.endswith('.pfa'):
+                    pfbs.append(token[1:])
+            else:
+                names.append(token)
+
+    return names, pfbs, encodings, psopts
 
 
 # Fontmap handles loading of fontmap, and determines encodings and files to use
 class FontMap(object):
-    """Handles TeX's fontmaps"""
+    """
+    Handles TeX's fontmaps. Nothing is read until the map is first used, and
+    the parsed map is cached on disk for the next process.
+
+    """
     def __init__(self, fontmap='psfonts.map'):
-        fontmap = open(kpsewhich(fontmap))
-        try:
+        self._fontmap = fontmap
+        self._mapping = None
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._encodings = {}
+        self._pfbs = {}
+        self.cache = DiskCache('fontmap', FONTMAP_CACHE_VERSION,
+                               max_size=16 << 20,
+                               dumps=marshal.dumps, loads=marshal.loads)
+
+    @property
+    def mapping(self):
+        if self._mapping is None:
+            with self._lock:
+                if self._mapping is None:
+                    self._mapping = self._load()
+        return self._mapping
+
+    def _load(self):
+        filename = kpsewhich(self._fontmap)
+        mtime = _mtime(filename)
+
+        cached = self.cache.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(filename) as fontmap:
             mapping = []
             for a, b in (line.split(' ', 1) for line in fontmap):
                 mapping.append((a, b))
                 if a.endswith('--base'):
                     mapping.append((a[:-6], b))
 
-            self._mapping = dict(mapping)
-        finally:
-            fontmap.close()
-
-        self._encodings = {}
-        self._pfbs = {}
+        mapping = dict(mapping)
+        self.cache.put(filename, (mtime, mapping))
+        return mapping
 
     def get(self, fontname):
-        line = self._mapping.get(fontname)
+        tokens = self._tokens.get(fontname)
+        if tokens is None:
+            line = self.mapping.get(fontname)
 
-        if not line:
-            return None
+            if not line:
+                return None
 
-        in_quote = False
-        names = []
-        psopts = []
-        pfbs = []
-        encodings = []
+            tokens = self._tokens[fontname] = tokenize_map_line(line)
 
-        for token in line.split():
-            if in_quote:
-                if token == '"':
-                    in_quote = False
-                else:
-                    psopts.append(token)
-            else:
-                if token == '"':
-                    in_quote = True
-                elif token.startswith('<<'):
-                    pfbs.append(token[2:])
-                elif token.startswith('<['):
-                    encodings.append(token[2:])
-                elif token.startswith('<'):
-                    r = token[1:]
-                    if r.endswith('.enc'):
-                        encodings.append(r)
-                    elif r.endswith('.pfb') or r.endswith('.pfa'):
-                        pfbs.append(token[1:])
-                else:
-                    names.append(token)
+        names, pfbs, encodings, psopts = tokens
 
         def read_encoding(enc):
             # TODO: HACK HACK HACK HACK HACK!
@@ -229,16 +545,20 @@ class FontMap(object):
 
         all_encs = self._encodings
 
+        # Look up every new file with a single kpsewhich
         new_encodings = frozenset(encodings).difference(self._encodings)
+        new_pfbs = frozenset(pfbs).difference(self._pfbs)
+        resolver.find_many(new_encodings | new_pfbs)
+
         self._encodings.update(zip(new_encodings, map(read_encoding, new_encodings)))
 
         encodings = [(e, all_encs[e]) for e in encodings]
 
-        self._pfbs.update((i, kpsewhich(i)) for i in frozenset(pfbs).difference(self._pfbs))
+        self._pfbs.update((i, kpsewhich(i)) for i in new_pfbs)
 
         pfbs = [self._pfbs[i] for i in pfbs]
 
-        return names, pfbs, encodings, psopts
+        return list(names), pfbs, encodings, list(psopts)
 
 
 fontmap = FontMap()
@@ -271,59 +591,202 @@ def tfm_widths(stream, n, z, read_bytes=read_bytes):
         yield in_width
 
 
+def tfm_widths_array(data, offset, n, z):
+    """
+    As tfm_widths, but decoding the `n` fix_words at `offset` in `data` all at
+    once with NumPy. The results are identical, down to the last bit.
+
+    """
+    alpha = 16
+    while z >= 0o40000000:
+        z //= 2
+        alpha += alpha
+
+    beta = 256 // alpha
+    alpha *= z
+
+    b = np.frombuffer(data, np.uint8, 4 * n, offset).reshape(n, 4)
+    b = b.astype(np.int64)
+    b0, b1, b2, b3 = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+
+    # Everything is non-negative here, so floor division is exactly TeX's
+    in_width = (((((b3 * z) // 0o400) + (b2 * z)) // 0o400) + (b1 * z)) // beta
+
+    if ((b0 > 0) & (b0 < 255)).any():
+        raise RuntimeError('Invalid width in TFM file')
+    in_width[b0 == 255] -= alpha
+
+    return in_width
+
+
 # This is the order of fields in the font
 #    'lf', 'lh', 'bc', 'ec', 'nw', 'nh',
 #    'nd', 'ni', 'nl', 'nk', 'ne', 'np'
 
-class FontMetrics(object):
-    def __init__(self, fontname, scale, d=None, n=None):
-        self.n = n
-        self.d = d
-        self.name = fontname
+def read_tfm(filename, scale, d, vectorize=True):
+    """
+    Read the metrics we need from a TFM file. Return the font size, the first
+    character code, and the widths, heights and depths of each character from
+    there on.
+
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if vectorize and np is not None:
+        return _read_tfm_array(data, scale, d)
+
+    stream = iter(bytearray(data))
+
+    lengths = read_array(stream, I2, 12)
+
+    header = read_array(stream, I4, lengths[1])
+    size = (header[1] / float(1<<20)) * (float(scale) / d)
+    bc = lengths[2]
+    ec = lengths[3]
+    nc = 1 + ec - bc
+    char_info = read_bytes(stream, 4 * nc)
+
+    widths = list(tfm_widths(stream, lengths[4], scale))
+    heights = list(tfm_widths(stream, lengths[5], scale))
+    depths = list(tfm_widths(stream, lengths[6], scale))
+
+    it = iter(char_info)
+
+    ws = array('i')
+    hs = array('i')
+    ds = array('i')
+    for i in xrange(bc, 1+ec):
+        width_ix = next(it)
+        b = next(it)
+        height_ix = (0xf0 & b) >> 4
+        depth_ix = 0x0f & b
+        next(it)
+        next(it)
+
+        ws.append(widths[width_ix])
+        hs.append(heights[height_ix])
+        ds.append(depths[depth_ix])
+
+    return size, bc, ws, hs, ds
+
+
+def _read_tfm_array(data, scale, d):
+    # As read_tfm, but with NumPy doing all of the per-character work
+    lengths = struct.unpack_from('>12H', data)
+    lh, bc, ec, nw, nh, nd = lengths[1:7]
+
+    design_size, = struct.unpack_from('>I', data, 28)
+    size = (design_size / float(1<<20)) * (float(scale) / d)
+    nc = 1 + ec - bc
+
+    offset = 24 + 4 * lh
+    char_info = np.frombuffer(data, np.uint8, 4 * nc, offset).reshape(nc, 4)
+    offset += 4 * nc
+    widths = tfm_widths_array(data, offset, nw, scale)
+    offset += 4 * nw
+    heights = tfm_widths_array(data, offset, nh, scale)
+    offset += 4 * nh
+    depths = tfm_widths_array(data, offset, nd, scale)
+
+    def to_array(a):
+        return array('i', a.astype(np.intc).tostring())
+
+    return (size, bc,
+            to_array(widths[char_info[:, 0]]),
+            to_array(heights[char_info[:, 1] >> 4]),
+            to_array(depths[char_info[:, 1] & 0x0f]))
+
+
+# Bump whenever the layout of the cached metrics changes
+METRICS_CACHE_VERSION = 1
+
+metrics_cache = DiskCache('metrics', METRICS_CACHE_VERSION, max_size=16 << 20,
+                          dumps=marshal.dumps, loads=marshal.loads)
+
+# Metrics already loaded by this process, keyed on (fontname, scale, design
+# size)
+_metrics = {}
+
+
+def _load_metrics(fontname, scale, d):
+    # The cached entry remembers which TFM file it came from, so it can be
+    # checked against that file's mtime without running kpsewhich at all
+    key = '%s %d %d' % (fontname, scale, d)
+    cached = metrics_cache.get(key)
+    if cached is not None:
+        filename, mtime, size, bc, ws, hs, ds = cached
+        if mtime is not None and _mtime(filename) == mtime:
+            return size, bc, array('i', ws), array('i', hs), array('i', ds)
 
-        filename = kpsewhich('%s.tfm' % fontname)
+    filename = kpsewhich('%s.tfm' % fontname)
+    size, bc, ws, hs, ds = metrics = read_tfm(filename, scale, d)
+    metrics_cache.put(key, (filename, _mtime(filename), size, bc,
+                            ws.tostring(), hs.tostring(), ds.tostring()))
+    return metrics
 
-        with open(filename, 'r') as f:
-            stream = iter(bytearray(f.read()))
 
-        lengths = read_array(stream, I2, 12)
+class CharMetrics(object):
+    """
+    The metrics of every character in a font, held in three flat arrays which
+    start at the first character code, `bc`. Indexing by character code gives
+    (width, height, depth), as a dict would; hot paths should index `widths`
+    directly.
+
+    """
+    __slots__ = ('bc', 'widths', 'heights', 'depths')
+    def __init__(self, bc, widths, heights, depths):
+        self.bc = bc
+        self.widths = widths
+        self.heights = heights
+        self.depths = depths
 
-        header = read_array(stream, I4, lengths[1])
-        self.size = (header[1] / float(1<<20)) * (float(scale) / self.d)
-        bc = lengths[2]
-        ec = lengths[3]
-        nc = 1 + ec - bc
-        char_info = read_bytes(stream, 4 * nc)
+    def __getitem__(self, i):
+        j = i - self.bc
+        if j < 0 or j >= len(self.widths):
+            raise KeyError(i)
+        return self.widths[j], self.heights[j], self.depths[j]
 
-        widths = list(tfm_widths(stream, lengths[4], scale))
-        heights = list(tfm_widths(stream, lengths[5], scale))
-        depths = list(tfm_widths(stream, lengths[6], scale))
+    def __contains__(self, i):
+        return 0 <= i - self.bc < len(self.widths)
 
-        it = iter(char_info)
+    def __len__(self):
+        return len(self.widths)
 
-        chars = []
-        for i in xrange(bc, 1+ec):
-            width_ix = next(it)
-            b = next(it)
-            height_ix = (0xf0 & b) >> 4
-            depth_ix = 0x0f & b
-            next(it)
-            next(it)
 
-            chars.append((i, (
-                widths[width_ix],
-                heights[height_ix],
-                depths[depth_ix])))
+def load_metrics(fontname, scale, d):
+    """
+    Return the size and CharMetrics of the given font, loading them at most
+    once per process, and at most once per TFM file across processes.
+
+    """
+    key = fontname, scale, d
+    metrics = _metrics.get(key)
+    if metrics is None:
+        size, bc, ws, hs, ds = _load_metrics(fontname, scale, d)
+        metrics = _metrics[key] = size, CharMetrics(bc, ws, hs, ds)
+    return metrics
 
 
-        self.chars = dict(chars)
+class FontMetrics(object):
+    def __init__(self, fontname, scale, d=None, n=None):
+        self.n = n
+        self.d = d
+        self.scale = scale
+        self.name = fontname
+        self.size, self.chars = load_metrics(fontname, scale, d)
+        # For set_char_i, which only ever needs the width
+        self.bc = self.chars.bc
+        self.widths = self.chars.widths
 
 
 # Dispatchers
 class Dispatcher(object):
     """Hides a _lot_ of the complexity / boilerplate"""
-    def __init__(self):
+    def __init__(self, buffered=False, table_reader=None):
         self.ops = {}
+        self.buffered = buffered
+        self.table_reader = table_reader
 
     # A contextmanager that returns a decorator. What could be simpler? :)
     @contextmanager
@@ -346,6 +809,9 @@ class Dispatcher(object):
         sorted_ops = sorted(ops.iteritems(), key=operator.itemgetter(0))
         dispatch = dict()
         lookup = dict()
+        # The same as dispatch, but as a flat list of (func, n) without any
+        # partials, for the table readers
+        table = [None] * 256
 
         for (a, func), (b, _) in itertools.izip(sorted_ops, sorted_ops[1:]):
             d = b - a
@@ -353,8 +819,10 @@ class Dispatcher(object):
             if d > 1:
                 for i, j in enumerate(xrange(a, b), 1):
                     dispatch[j] = partial(func, i)
+                    table[j] = func, i
             elif d == 1:
                 dispatch[a] = partial(func, 0)
+                table[a] = func, 0
             elif d == 0:
                 raise RuntimeError('Overlapping opcodes')
 
@@ -364,9 +832,10 @@ class Dispatcher(object):
             lookup[fn] = s
         self.lookup = lookup
         self.dispatch = dispatch
+        self.table = table
 
 
-    def reader(self, whitelist=(), blacklist=(), end_on=()):
+    def reader(self, whitelist=(), blacklist=(), end_on=(), compiled=True):
 
         dispatch = self.dispatch
         lookup = self.lookup
@@ -379,10 +848,19 @@ class Dispatcher(object):
 
         if whitelist:
             whitelist = set().union(*(lookup[i] for i in whitelist))
-            return WhitelistReader(whitelist, end_on, dispatch)
-
         elif blacklist:
             blacklist = set().union(*(lookup[i] for i in blacklist))
+
+        if self.buffered:
+            allowed = whitelist or set(xrange(256)) - blacklist
+            if compiled:
+                reader = self.table_reader or TableReader
+                return reader(allowed, end_on, self.table)
+            return BufferReader(allowed, end_on, dispatch)
+
+        if whitelist:
+            return WhitelistReader(whitelist, end_on, dispatch)
+        elif blacklist:
             return BlacklistReader(blacklist, end_on, dispatch)
 
 
@@ -430,6 +908,227 @@ class BlacklistReader(object):
                 return
 
 
+class BufferReader(object):
+    """
+    Reads from a ByteBuffer. If an opcode's parameters have not all arrived
+    yet, the buffer is rewound to the opcode, topped up, and the opcode read
+    again; every operation reads its parameters before acting on them.
+
+    """
+    def __init__(self, allowed, end_on, dispatch):
+        self.allowed = allowed
+        self.end_on = end_on
+        self.dispatch = dispatch
+
+    def __call__(self, buf, state):
+        dispatch = self.dispatch
+        allowed = self.allowed
+        end_on = self.end_on
+        data = buf.data
+
+        while True:
+            start = buf.pos
+            try:
+                opcode = data[start]
+            except IndexError:
+                buf.fill()
+                continue
+
+            if opcode not in allowed:
+                raise RuntimeError('Opcode %d not allowed here' % opcode)
+
+            buf.pos = start + 1
+            try:
+                dispatch[opcode](buf, state)
+            except Underflow:
+                buf.pos = start
+                buf.fill()
+                continue
+
+            if opcode in end_on:
+                return
+
+
+class TableReader(object):
+    """
+    Reads from a ByteBuffer like BufferReader, but dispatches through a flat
+    list indexed by opcode. The white/blacklist and end_on are folded into one
+    flag per opcode: 0 if the opcode is not allowed, 1 if it is, and 2 if it
+    ends the read.
+
+    """
+    def __init__(self, allowed, end_on, table):
+        self.table = table
+        self.flags = [
+            ((2 if i in end_on else 1) if i in allowed and table[i] else 0)
+            for i in xrange(256)]
+
+    def __call__(self, buf, state):
+        table = self.table
+        flags = self.flags
+        data = buf.data
+
+        while True:
+            start = buf.pos
+            try:
+                opcode = data[start]
+            except IndexError:
+                buf.fill()
+                continue
+
+            flag = flags[opcode]
+            if not flag:
+                raise RuntimeError('Opcode %d not allowed here' % opcode)
+
+            func, n = table[opcode]
+            buf.pos = start + 1
+            try:
+                func(n, buf, state)
+            except Underflow:
+                buf.pos = start
+                buf.fill()
+                continue
+
+            if flag == 2:
+                return
+
+
+def _at_reader(fmt, combine=False):
+    # Like _buf_reader, but reading at an offset rather than from a ByteBuffer
+    unpack_from = struct.Struct(fmt).unpack_from
+    error = struct.error
+
+    if not combine:
+        def at(data, pos):
+            try:
+                return unpack_from(data, pos)[0]
+            except error:
+                raise Underflow
+    else:
+        def at(data, pos):
+            try:
+                hi, lo = unpack_from(data, pos)
+            except error:
+                raise Underflow
+            return (hi << 16) | lo
+    return at
+
+signed_at = (None, _at_reader('>b'), _at_reader('>h'),
+             _at_reader('>bH', combine=True), _at_reader('>i'))
+
+# Parameter bytes of right (143), w (147), x (152), down (157), y (161) and
+# z (166), which all move by a signed amount
+_move_bytes = [0] * 256
+for _op, _first in ((143, 1), (147, 0), (152, 0), (157, 1), (161, 0), (166, 0)):
+    for _n in xrange(_first, 5):
+        _move_bytes[_op + _n - _first] = _n
+del _op, _first, _n
+
+
+class DviTableReader(TableReader):
+    """
+    A TableReader for DVI, with the most common opcodes -- set_char_i, push,
+    pop, the movements and fnt_num_i -- done inline, rather than through a
+    function call per opcode. Everything else goes through the table.
+
+    """
+    def __call__(self, buf, state,
+                 signed_at=signed_at, move_bytes=_move_bytes):
+        table = self.table
+        flags = self.flags
+        data = buf.data
+        pos = buf.pos
+
+        while True:
+            try:
+                opcode = data[pos]
+            except IndexError:
+                buf.pos = pos
+                buf.fill()
+                pos = 0
+                continue
+
+            flag = flags[opcode]
+            if not flag:
+                buf.pos = pos
+                raise RuntimeError('Opcode %d not allowed here' % opcode)
+
+            if opcode < 128:
+                # set_char_i
+                font = state.font
+                j = opcode - font.bc
+                if j < 0 or j >= len(font.widths):
+                    # A negative index would quietly wrap around
+                    buf.pos = pos
+                    raise KeyError(opcode)
+                state.on_put_char(state, opcode)
+                state.h += font.widths[j]
+                pos += 1
+
+            elif 141 <= opcode < 171:
+                if opcode == 141:
+                    state.push()
+                    pos += 1
+                elif opcode == 142:
+                    state.pop()
+                    pos += 1
+                else:
+                    n = move_bytes[opcode]
+                    if n:
+                        try:
+                            value = signed_at[n](data, pos + 1)
+                        except Underflow:
+                            buf.pos = pos
+                            buf.fill()
+                            pos = 0
+                            continue
+                    pos += 1 + n
+
+                    if opcode < 147:
+                        state.h += value
+                    elif opcode < 152:
+                        if n:
+                            state.w = value
+                        state.h += state.w
+                    elif opcode < 157:
+                        if n:
+                            state.x = value
+                        state.h += state.x
+                    elif opcode < 161:
+                        state.v += value
+                    elif opcode < 166:
+                        if n:
+                            state.y = value
+                        state.v += state.y
+                    else:
+                        if n:
+                            state.z = value
+                        state.v += state.z
+
+            elif 171 <= opcode < 235:
+                # fnt_num_i
+                k = opcode - 171
+                state.font = font = state.fonts[k]
+                state.on_fnt(state, font, k)
+                pos += 1
+
+            else:
+                func, n = table[opcode]
+                buf.pos = pos + 1
+                try:
+                    func(n, buf, state)
+                except Underflow:
+                    buf.pos = pos
+                    buf.fill()
+                    pos = 0
+                    continue
+                pos = buf.pos
+
+            if flag == 2:
+                buf.pos = pos
+                return
+
+
 def default_char(state, char): pass
 def default_rule(state, a, b): pass
 def default_fnt_def(fnt): pass
@@ -502,7 +1201,9 @@ class TexSizer():
         self.bottom = max(self.bottom, st.v + d)
 
     def on_put_rule(self, s, a, b):
-        v, h = s.v, s.h
+        self.add_rule(s.h, s.v, a, b)
+
+    def add_rule(self, h, v, a, b):
         self.left = min(self.left, h, h + b)
         self.right = max(self.right, h, h + b)
 
@@ -546,199 +1247,221 @@ class TexSizer():
 # allows for a reduction of duplication, and still allows all the flexibility
 # required.
 
-dvi = Dispatcher()
-with dvi.op() as op:
+def dvi_ops(unsigned, signed, read_string, buffered=False, Font=FontMetrics):
+    """
+    Build the DVI dispatcher, reading parameters with the given readers: either
+    the byte iterator readers or the buffer readers.
 
-    @op(0, 1)
-    def set_char_i(i, stream, state):
-        """Typeset the character with code i and move right by its width"""
-        state.on_put_char(state, i)
-        state.h += state.font.chars[i][0]
+    """
+    I1, I4 = unsigned[1], unsigned[4]
+
+    dvi = Dispatcher(buffered, table_reader=DviTableReader)
+    with dvi.op() as op:
+
+        @op(0, 1)
+        def set_char_i(i, stream, state):
+            """Typeset the character with code i and move right by its width"""
+            font = state.font
+            j = i - font.bc
+            if j < 0 or j >= len(font.widths):
+                raise KeyError(i)
+            state.on_put_char(state, i)
+            state.h += font.widths[j]
+
+        @op(128)
+        def set_char(n, stream, state,
+                    set_char_i=set_char_i,
+                     unsigned=unsigned):
+            """
+            Typeset the character contained in the n-byte parameter and move
+            right by its width
+
+            """
+            set_char_i(unsigned[n](stream), stream, state)
+
+        @op(133)
+        def put_char(n, stream, state,
+                     unsigned=unsigned):
+            state.on_put_char(state, unsigned[n](stream))
+
+        @op(137)
+        def put_rule(_, stream, state, fmt=fmt(signed[4], signed[4])):
+            a, b = fmt(stream)
+            state.on_put_rule(state, a, b)
+            return b
+
+        @op(132)
+        def set_rule(_, stream, state, put_rule=put_rule):
+            state.h += put_rule(_, stream, state)
+
+        @op(138)
+        def nop(_, stream, state):
+            """By definition does nothing"""
+            return
 
-    @op(128)
-    def set_char(n, stream, state,
-                set_char_i=set_char_i,
-                 unsigned=unsigned):
-        """
-        Typeset the character contained in the n-byte parameter and move
-        right by its width
+        @op(139)
+        def bop(_, stream, state, I4=I4, i4=signed[4]):
+            c = read_array(stream, I4, 10)
+            p = i4(stream)
 
-        """
-        set_char_i(unsigned[n](stream), stream, state)
-
-    @op(133)
-    def put_char(n, stream, state,
-                 unsigned=unsigned):
-        state.on_put_char(state, unsigned[n](stream))
-
-    @op(137)
-    def put_rule(_, stream, state, fmt=fmt(i4, i4)):
-        a, b = fmt(stream)
-        state.on_put_rule(state, a, b)
-        return b
-
-    @op(132)
-    def set_rule(_, stream, state, put_rule=put_rule):
-        state.h += put_rule(_, stream, state)
-
-    @op(138)
-    def nop(_, stream, state):
-        """By definition does nothing"""
-        return
-
-    @op(139)
-    def bop(_, stream, state, i4=i4, I4=I4):
-        c = read_array(stream, I4, 10)
-        p = i4(stream)
-
-    @op(140)
-    def eop(_, stream, state):
-        return
-
-    @op(141)
-    def push(_, stream, state):
-        state.push()
-
-    @op(142)
-    def pop(_, stream, state):
-        state.pop()
-
-    @op(143)
-    def right(n, stream, state, signed=signed):
-        state.h += signed[n](stream)
-
-    @op(147, 148)
-    def w(n, stream, state, signed=signed):
-        """Move right by w"""
-        if n:
-            state.w = signed[n](stream)
-        state.h += state.w
-
-    @op(152, 153)
-    def x(n, stream, state, signed=signed):
-        """Move right by x"""
-        if n:
-            state.x = signed[n](stream)
-        state.h += state.x
-
-    @op(157)
-    def down(n, stream, state,signed=signed):
-        state.v += signed[n](stream)
-
-    @op(161, 162)
-    def y(n, stream, state, signed=signed):
-        """Move down by y"""
-        if n:
-            state.y = signed[n](stream)
-        state.v += state.y
-
-    @op(166, 167)
-    def z(n, stream, state, signed=signed):
-        if n:
-            state.z = signed[n](stream)
-        state.v += state.z
-
-    @op(171, 172)
-    def fnt_num_i(i, stream, state):
-        state.font = state.fonts[i]
-        state.on_fnt(state, state.font, i)
-
-    @op(235)
-    def fnt(n, stream, state, unsigned=unsigned):
-        i = unsigned[n](stream)
-        fnt_num_i(i, stream, state)
-
-    @op(239)
-    def xxx(n, stream, state, unsigned=unsigned, read_string=read_string):
-        l = unsigned[n](stream)
-        read_string(stream, l)
-
-    @op(243)
-    def fnt_def(n, stream, state,
-                unsigned=unsigned,
-                fmt=fmt(I4, I4, I4, I1, I1),
-                Font=FontMetrics
+        @op(140)
+        def eop(_, stream, state):
+            return
+
+        @op(141)
+        def push(_, stream, state):
+            state.push()
+
+        @op(142)
+        def pop(_, stream, state):
+            state.pop()
+
+        @op(143)
+        def right(n, stream, state, signed=signed):
+            state.h += signed[n](stream)
+
+        @op(147, 148)
+        def w(n, stream, state, signed=signed):
+            """Move right by w"""
+            if n:
+                state.w = signed[n](stream)
+            state.h += state.w
+
+        @op(152, 153)
+        def x(n, stream, state, signed=signed):
+            """Move right by x"""
+            if n:
+                state.x = signed[n](stream)
+            state.h += state.x
+
+        @op(157)
+        def down(n, stream, state,signed=signed):
+            state.v += signed[n](stream)
+
+        @op(161, 162)
+        def y(n, stream, state, signed=signed):
+            """Move down by y"""
+            if n:
+                state.y = signed[n](stream)
+            state.v += state.y
+
+        @op(166, 167)
+        def z(n, stream, state, signed=signed):
+            if n:
+                state.z = signed[n](stream)
+            state.v += state.z
+
+        @op(171, 172)
+        def fnt_num_i(i, stream, state):
+            state.font = state.fonts[i]
+            state.on_fnt(state, state.font, i)
+
+        @op(235)
+        def fnt(n, stream, state, unsigned=unsigned):
+            i = unsigned[n](stream)
+            fnt_num_i(i, stream, state)
+
+        @op(239)
+        def xxx(n, stream, state, unsigned=unsigned, read_string=read_string):
+            l = unsigned[n](stream)
+            read_string(stream, l)
+
+        @op(243)
+        def fnt_def(n, stream, state,
+                    unsigned=unsigned,
+                    fmt=fmt(I4, I4, I4, I1, I1),
+                    Font=Font
+                   ):
+            k = unsigned[n](stream)
+            c, s, d, a, l = fmt(stream)
+            name = read_string(stream, a + l)
+
+            state.fonts[k] = font = Font(name, s, d, k)
+
+            state.on_fnt_def(font)
+
+        @op(247)
+        def pre(_, stream, state,
+                fmt=fmt(I1, I4, I4, I4, I1),
+                read_string=read_string
                ):
-        k = unsigned[n](stream)
-        c, s, d, a, l = fmt(stream)
-        name = read_string(stream, a + l)
-
-        state.fonts[k] = font = Font(name, s, d, k)
-
-        state.on_fnt_def(font)
-
-    @op(247)
-    def pre(_, stream, state,
-            fmt=fmt(I1,I4,I4,I4,I1),
-            read_string=read_string
-           ):
-        i, num, den, mag, k = fmt(stream)
-        state.num = num
-        state.den = den
-        state.mag = mag
-        x = read_string(stream, k)
-
-    @op(248)
-    def post(_, stream, state):
-        # We really have no need to disturb the postamble, as we read in
-        # files sequentially
-        raise(RuntimeError, 'Postamble detected in unexpected place')
-
-    @op(249)
-    def post_post(_, stream, state):
-        # Nor do we have reason to read in post post
-        raise(RuntimeError, 'Post-postamble detected in unexpected place')
-
-    @op(250)
-    def undefined(_, stream, state):
-        raise(RuntimeError, 'Undefined opcode')
-
-vf = Dispatcher()
-with vf.op() as op:
-    def _add_char(pl, cc, tfm, stream, state):
-        dvi = read_string(stream, pl)
-        state.chars[cc] = dvi
-
-    @op(247)
-    def pre(_, stream, state,
-            read_string=read_string,
-            fmt1=fmt(I1, I1), fmt2=fmt(I4, I4)):
-        i, k = fmt1(stream)
-        x = read_string(stream, k)
-        cs, ds = fmt2(stream)
-
-    @op(0, 1)
-    def short_char_i(pl, stream, state,
-                     _add_char=_add_char,
-                     fmt=fmt(I1, I3)):
-        cc, tfm = fmt(stream)
-        _add_char(pl, cc, tfm, stream, state)
-
-    @op(242)
-    def long_char_i(i, stream, state,
-                    _add_char=_add_char,
-                    fmt=fmt(I4, I4, I4)):
-        pl, cc, tfm = fmt(stream)
-        _add_char(pl, cc, tfm, stream, state)
-
-    @op(243)
-    def fnt_def(n, stream, state,
-                fmt=fmt(I4, I4, I4, I1, I1),
-                Font=FontMetrics):
-
-
-        k = unsigned[n](stream)
-        c, s, d, a, l = fmt(stream)
-        n = read_string(stream, a + l)
-        state.fonts[k] = Font(n, s, d, k)
-
-    @op(248)
-    def post(_, stream, state):
-        pass
+            i, num, den, mag, k = fmt(stream)
+            state.num = num
+            state.den = den
+            state.mag = mag
+            x = read_string(stream, k)
+
+        @op(248)
+        def post(_, stream, state):
+            # We really have no need to disturb the postamble, as we read in
+            # files sequentially
+            raise(RuntimeError, 'Postamble detected in unexpected place')
+
+        @op(249)
+        def post_post(_, stream, state):
+            # Nor do we have reason to read in post post
+            raise(RuntimeError, 'Post-postamble detected in unexpected place')
+
+        @op(250)
+        def undefined(_, stream, state):
+            raise(RuntimeError, 'Undefined opcode')
+
+    return dvi
+
+
+def vf_ops(unsigned, read_string, buffered=False, Font=FontMetrics):
+    """Build the virtual font dispatcher, as for dvi_ops"""
+    I1, I3, I4 = unsigned[1], unsigned[3], unsigned[4]
+
+    vf = Dispatcher(buffered)
+    with vf.op() as op:
+        def _add_char(pl, cc, tfm, stream, state):
+            dvi = read_string(stream, pl)
+            state.chars[cc] = dvi
+
+        @op(247)
+        def pre(_, stream, state,
+                read_string=read_string,
+                fmt1=fmt(I1, I1), fmt2=fmt(I4, I4)):
+            i, k = fmt1(stream)
+            x = read_string(stream, k)
+            cs, ds = fmt2(stream)
+
+        @op(0, 1)
+        def short_char_i(pl, stream, state,
+                         _add_char=_add_char,
+                         fmt=fmt(I1, I3)):
+            cc, tfm = fmt(stream)
+            _add_char(pl, cc, tfm, stream, state)
+
+        @op(242)
+        def long_char_i(i, stream, state,
+                        _add_char=_add_char,
+                        fmt=fmt(I4, I4, I4)):
+            pl, cc, tfm = fmt(stream)
+            _add_char(pl, cc, tfm, stream, state)
+
+        @op(243)
+        def fnt_def(n, stream, state,
+                    fmt=fmt(I4, I4, I4, I1, I1),
+                    Font=Font):
+
+
+            k = unsigned[n](stream)
+            c, s, d, a, l = fmt(stream)
+            n = read_string(stream, a + l)
+            state.fonts[k] = Font(n, s, d, k)
+
+        @op(248)
+        def post(_, stream, state):
+            pass
+
+        @op(249)
+        def undef(i, stream, state):
+            pass
+
+    return vf
 
-    @op(249)
-    def undef(i, stream, state):
-        pass
 
 class VfState(object):
     __slots__ = 'fonts', 'chars', 'scale'
@@ -746,12 +1469,98 @@ class VfState(object):
         self.fonts = {}
         self.chars = {}
 
-read_pre = dvi.reader(whitelist=['pre', 'nop'], end_on=['pre'])
-read_bop = dvi.reader(whitelist=['bop', 'nop', 'fnt_def'], end_on=['bop'])
-read_eop = dvi.reader(blacklist=['pre', 'post', 'post_post'], end_on=['eop'])
-read_vf = dvi.reader(blacklist=['pre', 'post', 'post_post'], end_on=['eop'])
-vf_read_pre = vf.reader(whitelist=['pre'], end_on=['pre'])
-vf_read_main = vf.reader(blacklist=['pre'], end_on=['post'])
+
+# The byte iterator dispatchers are kept about for comparison; everything else
+# runs on the buffer readers.
+dvi = dvi_ops(unsigned, signed, read_string)
+vf = vf_ops(unsigned, read_string)
+
+dvi_buffer = dvi_ops(buf_unsigned, buf_signed, buf_read_string, buffered=True)
+vf_buffer = vf_ops(buf_unsigned, buf_read_string, buffered=True)
+
+read_pre = dvi_buffer.reader(whitelist=['pre', 'nop'], end_on=['pre'])
+read_bop = dvi_buffer.reader(whitelist=['bop', 'nop', 'fnt_def'], end_on=['bop'])
+read_eop = dvi_buffer.reader(blacklist=['pre', 'post', 'post_post'], end_on=['eop'])
+read_vf = dvi_buffer.reader(blacklist=['pre', 'post', 'post_post'], end_on=['eop'])
+vf_read_pre = vf_buffer.reader(whitelist=['pre'], end_on=['pre'])
+vf_read_main = vf_buffer.reader(blacklist=['pre'], end_on=['post'])
+
+class Page(object):
+    """
+    A typeset page, held in columns rather than as a tuple per glyph. Glyph k
+    is drawn at (x[k], y[k]) and is entry glyph[k] of the glyph table, `glyphs`,
+    a list of distinct (font, char) pairs; char is a glyph name if the font is
+    re-encoded and a character code otherwise. `fonts` holds the
+    (filename, size) of each font, and font[k] is the font of glyph k. `rules`
+    holds x, y, width and height for each rule in turn. All in points.
+
+    """
+    __slots__ = ('fonts', 'glyphs', 'x', 'y', 'glyph', 'font', 'rules',
+                 'size', 'bl', '_lookup')
+
+    def __init__(self):
+        self.fonts = []
+        self.glyphs = []
+        self.x = array('d')
+        self.y = array('d')
+        self.glyph = array('i')
+        self.font = array('i')
+        self.rules = array('d')
+        self.size = self.bl = 0, 0
+        # fontcore -> (font, {char: glyph}), only needed while building
+        self._lookup = {}
+
+    def __len__(self):
+        return len(self.glyph)
+
+    def add_char(self, x, y, char, fontcore):
+        try:
+            font, chars = self._lookup[fontcore]
+        except KeyError:
+            font, chars = self._lookup[fontcore] = len(self.fonts), {}
+            self.fonts.append(fontcore)
+
+        glyph = chars.get(char)
+        if glyph is None:
+            glyph = chars[char] = len(self.glyphs)
+            self.glyphs.append((font, char))
+
+        self.x.append(x)
+        self.y.append(y)
+        self.glyph.append(glyph)
+        self.font.append(font)
+
+    def add_rule(self, x, y, w, h):
+        self.rules.extend((x, y, w, h))
+
+    def finish(self, size, bl):
+        self.size = size
+        self.bl = bl
+        self._lookup = None
+        return self
+
+    def runs(self, groupby=itertools.groupby):
+        """Yield (font, start, end) for each run of glyphs in the same font"""
+        start = 0
+        for font, run in groupby(self.font):
+            end = start + sum(1 for _ in run)
+            yield font, start, end
+            start = end
+
+    def records(self):
+        """
+        Return the glyphs as a NumPy structured array with fields x, y, glyph
+        and font, or as a list of (x, y, glyph, font) tuples without NumPy.
+
+        """
+        if np is None:
+            return zip(self.x, self.y, self.glyph, self.font)
+        r = np.empty(len(self), dtype=[('x', 'f8'), ('y', 'f8'),
+                                       ('glyph', 'i4'), ('font', 'i4')])
+        for name in ('x', 'y', 'glyph', 'font'):
+            r[name] = np.frombuffer(getattr(self, name), dtype=r.dtype[name])
+        return r
+
 
 class T1Font(object):
     """
@@ -765,8 +1574,33 @@ class T1Font(object):
     def render(self, renderer, state, char):
         if self.enc:
             char = self.enc[char]
-        c = 'c', DVI2PT * state.h, DVI2PT * state.v, char, self.fontcore
-        renderer.page.append(c)
+        renderer.page.add_char(DVI2PT * state.h, DVI2PT * state.v, char,
+                               self.fontcore)
+
+
+class _VfRecorder(object):
+    """
+    The handler a VirtualFont runs its character programs against. It records
+    each glyph and rule relative to the point at which the character is set.
+
+    """
+    def __init__(self, psfonts):
+        self.fonts = psfonts
+        self.font = psfonts[0]
+        self.glyphs = []
+        self.rules = []
+
+    def on_put_char(self, s, i):
+        font = self.font
+        if font.enc:
+            i = font.enc[i]
+        self.glyphs.append((s.h, s.v, i, font.fontcore))
+
+    def on_put_rule(self, s, a, b):
+        self.rules.append((s.h, s.v, a, b))
+
+    def on_fnt(self, s, fnt, k):
+        self.font = self.fonts[k]
 
 
 class VirtualFont(object):
@@ -778,8 +1612,8 @@ class VirtualFont(object):
                  read_pre=vf_read_pre, read_main=vf_read_main):
         self.state = VfState()
 
-        with open(filename) as f:
-            stream = iter(bytearray(f.read()))
+        with open(filename, 'rb') as f:
+            stream = ByteBuffer(f.read())
 
         read_pre(stream, self.state)
         read_main(stream, self.state)
@@ -795,94 +1629,144 @@ class VirtualFont(object):
             encs = (encs and encs[0][1]) or None
             psfonts[i] = T1Font(psname, j, encs, texfont.size)
 
+        # Character programs, compiled on first use
+        self.compiled = {}
 
-    def render(self, renderer, state, i, read_vf=read_vf):
-        renderer.in_vf=True
-        stream = iter(bytearray(self.state.chars[i]))
-
-        texfont = state.font
-        texfonts = state.fonts
-        font = renderer.font
-        fonts = renderer.fonts
+    def compile(self, i, read_vf=read_vf):
+        """
+        Run the program for character i once. Return what it sets as a list of
+        (dx, dy, char, fontcore) glyphs and a list of (dx, dy, height, width)
+        rules, all in DVI units and relative to the current point.
 
+        """
+        recorder = _VfRecorder(self.psfonts)
+        state = DviState()
+        state.attach_handler(recorder)
         state.fonts = self.state.fonts
         state.font = self.font
-        renderer.fonts = self.psfonts
-        renderer.font = self.psfonts[0]
-
-        state.push()
-
-        state.w = 0
-        state.x = 0
-        state.y = 0
-        state.z = 0
+        state.state = 0, 0, 0, 0, 0, 0
 
         # This must be in a try block because the dvi commands can just exit
         # completely unexpectedly.
         try:
-            read_vf(stream, state)
+            read_vf(ByteBuffer(self.state.chars[i]), state)
         except TypeError:
             pass
         except StopIteration:
             pass
 
+        compiled = self.compiled[i] = recorder.glyphs, recorder.rules
+        return compiled
+
+    def render(self, renderer, state, i):
+        compiled = self.compiled.get(i)
+        if compiled is None:
+            compiled = self.compile(i)
+        glyphs, rules = compiled
+
+        h = state.h
+        v = state.v
+        add_char = renderer.page.add_char
+        for dx, dy, char, fontcore in glyphs:
+            add_char(DVI2PT * (h + dx), DVI2PT * (v + dy), char, fontcore)
+
+        if rules:
+            page = renderer.page
+            add_rule = renderer.sizer.add_rule
+            for dx, dy, a, b in rules:
+                page.add_rule(DVI2PT * (h + dx), DVI2PT * (v + dy),
+                              DVI2PT * b, DVI2PT * a)
+                add_rule(h + dx, v + dy, a, b)
+
+
+def make_font(texfont):
+    """Build the T1Font or VirtualFont that renders the given TeX font"""
+    r = fontmap.get(texfont.name)
+    if r:
+        names, pfbs, encs, psopts = r
+        psname = pfbs[0]
+        enc = encs[0][1] if encs else None
+        return T1Font(psname, texfont, enc)
+    else:
+        vffile = kpsewhich('%s.vf' % texfont.name)
+        return VirtualFont(vffile, texfont)
+
+
+class FontRegistry(object):
+    """
+    The fonts built for each fnt_def, shared by every page and every TexDaemon
+    in the process, keyed on the TeX font's name, scale and design size. At
+    most `max_fonts` are kept, the least recently used being dropped first.
 
-        state.pop()
-
-        state.font = texfont
-        state.fonts = texfonts
-        renderer.font = font
-        renderer.fonts = fonts
-        renderer.in_vf = False
+    """
+    def __init__(self, max_fonts=256, make_font=make_font):
+        self.max_fonts = max_fonts
+        self.make_font = make_font
+        self.fonts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, texfont):
+        key = texfont.name, texfont.scale, texfont.d
+        fonts = self.fonts
+        with self._lock:
+            font = fonts.pop(key, None)
+            if font is not None:
+                fonts[key] = font
+                self.hits += 1
+                return font
+            self.misses += 1
+
+        # Built outside the lock, as a VirtualFont can take a while. Two threads
+        # may build the same font at once; either copy will do.
+        font = self.make_font(texfont)
+        with self._lock:
+            fonts[key] = font
+            while len(fonts) > self.max_fonts:
+                fonts.popitem(last=False)
+        return font
+
+    def clear(self):
+        with self._lock:
+            self.fonts.clear()
+
+
+font_registry = FontRegistry()
 
 
 class DviSlave():
     # Since we ignore specials and all that nonsense, we only need to store a
-    # list of fonts, characters, and their positions. We can use a dispatcher
-    # pattern to make this work -- have a heterogenous list with various objects
-    # representing the renderings to perform. So really, all this does is handle
-    # virtual fonts and compile things down into DVI objects. So for instance,
-    # there will be lots and lots of tiny glyph objects.
+    # list of fonts, characters, and their positions. So really, all this does
+    # is handle virtual fonts and compile things down into the columns of a
+    # Page, which has no per-glyph objects at all.
     def __init__(self):
         self.fonts = {}
-        self.page = []
+        self.page = Page()
         self.sizer = TexSizer()
-        self.in_vf = False
 
     def clear_page(self):
         page = self.page
         (w, h), (b, l) = self.sizer.reset()
         size = DVI2PT * w, DVI2PT * h
         bl = DVI2PT * b, DVI2PT * l
-        self.page = []
-        return page, size, bl
+        self.page = Page()
+        return page.finish(size, bl)
 
     def on_put_char(self, state, i):
+        # Virtual fonts render from their compiled glyph lists, so this is only
+        # ever called for characters of the page's own fonts
         self.font.render(self, state, i)
-        # But if it's a virtual font how do we tell? ARRGH!
-        # After about ~1min of thinking, this inelegant solution was proposed!
-        if not self.in_vf:
-            self.sizer.on_put_char(state, i)
-
-    def on_fnt_def(self, texfont):
-        r = fontmap.get(texfont.name)
-        if r:
-            names, pfbs, encs, psopts = r
-            psname = pfbs[0]
-            enc = encs[0][1] if encs else None
-            font = T1Font(psname, texfont, enc)
-        else:
-            vffile = kpsewhich('%s.vf' % texfont.name)
-            font = VirtualFont(vffile, texfont)
+        self.sizer.on_put_char(state, i)
 
-        self.fonts[texfont.n] = font
+    def on_fnt_def(self, texfont, registry=font_registry):
+        self.fonts[texfont.n] = registry.get(texfont)
 
     def on_fnt(self, state, fnt, k):
         self.font = self.fonts[k]
 
     def on_put_rule(self, s, a, b):
-        rule = 'r', DVI2PT * s.h, DVI2PT * s.v, DVI2PT * b, DVI2PT * a
-        self.page.append(rule)
+        self.page.add_rule(DVI2PT * s.h, DVI2PT * s.v, DVI2PT * b, DVI2PT * a)
         self.sizer.on_put_rule(s, a, b)
 
 # This is something
@@ -1140,8 +2024,7 @@ def read_output(filename, output_queue, sync):
     slave = DviSlave()
     state.attach_handler(slave)
 
-    xs = itertools.chain.from_iterable(bytearray(i) for i in iterator_reader(f))
-
+    xs = ByteBuffer(source=iterator_reader(f))
 
     read_pre(xs, state)
     while True:
@@ -1174,6 +2057,32 @@ class TempDir(object):
         except:
             pass
 
+class PageFuture(object):
+    """The eventual result of a page submitted to a TexDaemon"""
+    def __init__(self, daemon, number):
+        self.number = number
+        self._daemon = daemon
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done = True
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Block until the page has been typeset, and return it"""
+        if not self._done:
+            self._daemon._wait(self)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
 class TexDaemon(object):
     def __init__(self, template=None, dir=None):
         self.input_queue = queue.Queue()
@@ -1181,6 +2090,7 @@ class TexDaemon(object):
         self.watch_queue = queue.Queue()
         self._template = template or DEFAULT_TEMPLATE
 
+        self.dead = False
         self.tempdir = TempDir(dir, prefix='texlet_')
 
         tex_pipe = self.tempdir.named_pipe('texlets.tex')
@@ -1209,24 +2119,82 @@ class TexDaemon(object):
         p = self._template.page('\LaTeX')
         self._put(p + '\n\n')
         self.sync.release()
-        self.watch_queue.get(timeout=5)
+        self._pageno, _ = self.watch_queue.get(timeout=5)
         self.output_queue.get()
 
+        # Pages in flight, in the order they were written
+        self._pending = collections.deque()
+        self._statuses = {}
+        self._submit_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+
     # TODO: Restart??? Error handling...
 
     def page(self, tex):
+        return self.submit(tex).result()
+
+    def page_many(self, texs):
+        """
+        Typeset many snippets at once. Every page is written before any result
+        is waited upon, so LaTeX never sits idle between snippets.
+
+        """
+        futures = [self.submit(tex) for tex in texs]
+        return [f.result() for f in futures]
+
+    def submit(self, tex):
+        """
+        Write a page for LaTeX to typeset, without waiting for it. Return a
+        PageFuture for the result.
+
+        """
         p = self._template.page(tex)
-        #print(p)
-        self._put(p + '\n\n')
-        self.sync.release()
-        try:
-            w = self.watch_queue.get(timeout=1.0)
-            o = self.output_queue.get(timeout=1.0)
-        except:
-            self._tex.kill()
-            self.tempdir.close()
-            raise RuntimeError('LaTeX has most probably crashed -- perhaps bad input?')
-        return w, o
+        if self.dead:
+            raise RuntimeError('LaTeX has crashed; this daemon is finished')
+        with self._submit_lock:
+            self._pageno += 1
+            future = PageFuture(self, self._pageno)
+            self._pending.append(future)
+            self._put(p + '\n\n')
+            self.sync.release()
+        return future
+
+    def _wait(self, future, timeout=1.0):
+        # Results are drained strictly in order: the DVI arrives in the order
+        # the pages were written, and the terminal output reports the page
+        # number that each status belongs to.
+        with self._drain_lock:
+            while not future.done():
+                head = self._pending[0]
+                try:
+                    while head.number not in self._statuses:
+                        n, errors = self.watch_queue.get(timeout=timeout)
+                        if n == -1:
+                            raise RuntimeError('\n'.join(errors))
+                        self._statuses[n] = errors
+                    o = self.output_queue.get(timeout=timeout)
+                except RuntimeError:
+                    # LaTeX gave up, and said why
+                    self._crashed()
+                    raise
+                except:
+                    self._crashed()
+                    raise RuntimeError('LaTeX has most probably crashed -- perhaps bad input?')
+
+                self._pending.popleft()
+                status = head.number, self._statuses.pop(head.number)
+                head._set((status, o))
+
+    def _crashed(self):
+        # Kill LaTeX and clean up after it, just the once
+        if self.dead:
+            return
+        self.dead = True
+        self._tex.kill()
+        self.tempdir.close()
+        error = RuntimeError('LaTeX crashed before this page was typeset')
+        while self._pending:
+            self._pending.popleft()._set(error=error)
 
     def _put(self, lines):
         # Want an Async wrapper around thread get
@@ -1243,3 +2211,182 @@ class TexDaemon(object):
             self.join()
         except:
             pass
+
+
+class TexDaemonPool(object):
+    """
+    A pool of TexDaemons sharing a single template. Snippets are handed to
+    whichever daemon is idle, and daemons that crash are replaced. The pool has
+    the same interface as a TexDaemon, so it can be provided as 'texdaemon'.
+
+    The pool never shrinks: a daemon that crashes leaves an empty slot, which
+    is filled with a new daemon when next used. If that fails, the error goes
+    to that caller and the slot stays empty for the next one to try.
+
+    """
+    def __init__(self, template=None, dir=None, size=None):
+        self._template = template or DEFAULT_TEMPLATE
+        self._dir = dir
+        self.size = size or multiprocessing.cpu_count()
+        self._idle = queue.Queue()
+
+        # Starting LaTeX is mostly waiting around, so start them all at once
+        started = queue.Queue()
+        def start():
+            try:
+                started.put(self._spawn())
+            except Exception as e:
+                started.put(e)
+
+        for _ in xrange(self.size):
+            daemon(start)
+
+        daemons = [started.get() for _ in xrange(self.size)]
+        errors = [d for d in daemons if isinstance(d, Exception)]
+        if errors:
+            for d in daemons:
+                if not isinstance(d, Exception):
+                    d.join()
+            raise errors[0]
+        for d in daemons:
+            self._idle.put(d)
+
+    def _spawn(self):
+        return TexDaemon(self._template, self._dir)
+
+    def _run(self, method, arg):
+        d = self._idle.get()
+        try:
+            if d is None:
+                d = self._spawn()
+            return getattr(d, method)(arg)
+        except RuntimeError:
+            # The daemon has already killed its process
+            d = None
+            raise
+        except:
+            # Whatever it was doing was cut short, so it can't be trusted.
+            # Killing it mustn't hide why.
+            exc = sys.exc_info()
+            if d is not None:
+                try:
+                    d._crashed()
+                except Exception:
+                    pass
+                d = None
+            raise exc[0], exc[1], exc[2]
+        finally:
+            # Always give the slot back, empty if need be
+            self._idle.put(d)
+
+    def page(self, tex):
+        return self._run('page', tex)
+
+    def page_many(self, texs):
+        """
+        Typeset many snippets, spread across all of the daemons. Results are
+        returned in the order of `texs`.
+
+        """
+        texs = list(texs)
+        n = min(self.size, len(texs))
+        results = [None] * len(texs)
+        errors = []
+
+        # Each daemon gets every n-th snippet, which it then pipelines
+        def work(i):
+            try:
+                results[i::n] = self._run('page_many', texs[i::n])
+            except Exception as e:
+                errors.append(e)
+
+        workers = [daemon(work, i) for i in xrange(n)]
+        for t in workers:
+            t.join()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def join(self):
+        while True:
+            try:
+                d = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            if d is not None:
+                d.join()
+
+
+# Bump whenever the page format returned by DviSlave.clear_page changes
+PAGE_CACHE_VERSION = 2
+
+page_cache = DiskCache('pages', PAGE_CACHE_VERSION)
+
+# The status reported for pages that never went near LaTeX
+CACHED = (0, [])
+
+
+class CachedTexDaemon(object):
+    """
+    A TexDaemon fronted by a persistent cache of typeset pages, keyed on the
+    template preamble, the daemon's arguments and the snippet. The daemon
+    itself is only spawned on the first miss, so fully cached pictures never
+    start LaTeX at all.
+
+    """
+    # Arguments to the daemon which make no difference to what it typesets
+    neutral_kwargs = frozenset(['dir', 'size'])
+
+    def __init__(self, template=None, daemon=TexDaemon, cache=page_cache,
+                 **kwargs):
+        self._template = template or DEFAULT_TEMPLATE
+        self._factory = partial(daemon, self._template, **kwargs)
+        self._kwargs = repr(sorted((k, v) for k, v in kwargs.iteritems()
+                                   if k not in self.neutral_kwargs))
+        self._daemon = None
+        self.cache = cache
+
+    @property
+    def daemon(self):
+        # A daemon which crashed is no more use, so start another. Pools look
+        # after their own daemons.
+        if self._daemon is None or getattr(self._daemon, 'dead', False):
+            self._daemon = self._factory()
+        return self._daemon
+
+    def key(self, tex):
+        return '%s\0%s\0%s' % (self._template.preamble, self._kwargs, tex)
+
+    def page(self, tex):
+        key = self.key(tex)
+        o = self.cache.get(key)
+        if o is not None:
+            return CACHED, o
+
+        w, o = self.daemon.page(tex)
+        self._store(key, w, o)
+        return w, o
+
+    def page_many(self, texs):
+        texs = list(texs)
+        keys = [self.key(tex) for tex in texs]
+        results = [self.cache.get(key) for key in keys]
+        results = [(CACHED, o) if o is not None else None for o in results]
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            typeset = self.daemon.page_many(texs[i] for i in missing)
+            for i, (w, o) in zip(missing, typeset):
+                self._store(keys[i], w, o)
+                results[i] = w, o
+        return results
+
+    def _store(self, key, w, o):
+        # Never cache anything LaTeX complained about
+        if not w[1]:
+            self.cache.put(key, o)
+
+    def join(self):
+        if self._daemon is not None:
+            self._daemon.join()